@@ -1,8 +1,13 @@
 import logging
-from reddit.subreddit_browser import SubredditBrowser
+from reddit.coordinator import WorkerCoordinator
+from reddit.media_cache import MediaCache
+from reddit.media_optimizer import MediaOptimizer
+from reddit.router import SubredditRouter
+from reddit.tmp_space import TmpSpaceManager
 from redis import Redis
 import secrets
 import settings
+from stats import StatCollector
 from telegram.telegram_wrapper import TelegramWrapper, TelegramAuthState
 import time
 
@@ -18,7 +23,16 @@ def main():
     logging.info(f"Connected to Redis instance at {secrets.redis_host}:{secrets.redis_port}")
 
     with TelegramWrapper(tdlib_log_file=settings.tel_log_file,
-                         tdlib_log_verbosity=settings.tel_log_verbosity) as telegram:
+                         tdlib_log_verbosity=settings.tel_log_verbosity,
+                         receive_timeout_min=settings.tel_receive_timeout_min,
+                         receive_timeout_max=settings.tel_receive_timeout_max,
+                         callback_workers=settings.tel_callback_workers,
+                         callback_queue_size=settings.tel_callback_queue_size,
+                         max_in_flight=settings.tel_max_in_flight,
+                         json_backend=settings.tel_json_backend,
+                         send_rate=settings.tel_send_rate,
+                         send_burst=settings.tel_send_burst,
+                         send_max_retries=settings.tel_send_max_retries) as telegram:
 
         while telegram.authentication_state != TelegramAuthState.READY:
 
@@ -37,20 +51,69 @@ def main():
 
             time.sleep(0.5)
 
-        with SubredditBrowser(reddit_creds={'client_id': secrets.red_client_id,
-                                            'client_secret': secrets.red_client_secret,
-                                            'username': secrets.red_username,
-                                            'password': secrets.red_password,
-                                            'user_agent': secrets.red_user_agent},
-                              subreddit_name=settings.red_subreddit_name,
-                              telegram_wrap=telegram,
-                              telegram_channel=settings.tel_channel_name,
-                              redis_db=redis,
-                              top_num=settings.red_top_entries_num,
-                              browse_delay=settings.red_browse_delay,
-                              tmp_dir=settings.red_tmp_dir) as reddit:
+        routes = [(settings.red_subreddit_name, settings.tel_channel_name)] + settings.red_extra_routes
+        coordinator = None
+        if settings.red_distributed:
+            coordinator = WorkerCoordinator(redis,
+                                            worker_id=settings.red_worker_id,
+                                            lease_ttl=settings.red_worker_lease)
+        media_cache = None
+        if settings.red_media_cache_size > 0:
+            media_cache = MediaCache(settings.red_media_cache_dir, settings.red_media_cache_size * 1024 * 1024)
+        media_optimizer = None
+        if settings.red_optimize_media:
+            media_optimizer = MediaOptimizer(workers=settings.red_optimize_workers,
+                                             max_image_side=settings.red_max_image_side,
+                                             max_image_size=settings.red_max_image_size * 1024 * 1024,
+                                             max_video_size=settings.red_max_video_size * 1024 * 1024)
+        tmp_space = TmpSpaceManager(settings.red_tmp_dir,
+                                    quota=settings.red_tmp_quota * 1024 * 1024,
+                                    orphan_ttl=settings.red_tmp_orphan_ttl,
+                                    sweep_interval=settings.red_tmp_sweep_interval)
+
+        def create_stat_collector(db_prefix: str) -> StatCollector:
+            return StatCollector(redis,
+                                 db_prefix,
+                                 flush_every=settings.stats_flush_every,
+                                 flush_interval=settings.stats_flush_interval)
+
+        with SubredditRouter(reddit_creds={'client_id': secrets.red_client_id,
+                                           'client_secret': secrets.red_client_secret,
+                                           'username': secrets.red_username,
+                                           'password': secrets.red_password,
+                                           'user_agent': secrets.red_user_agent},
+                             routes=routes,
+                             telegram_wrap=telegram,
+                             redis_db=redis,
+                             stat_collector_factory=create_stat_collector,
+                             listing_ttl=settings.red_listing_ttl,
+                             coordinator=coordinator,
+                             top_num=settings.red_top_entries_num,
+                             browse_delay=settings.red_browse_delay,
+                             tmp_dir=settings.red_tmp_dir,
+                             download_workers=settings.red_download_workers,
+                             av_mux_mode=settings.red_av_mux_mode,
+                             batched_dedup=settings.red_batched_dedup,
+                             album_batching=settings.red_album_batching,
+                             album_flush_delay=settings.red_album_flush_delay,
+                             paced_posting=settings.red_paced_posting,
+                             pacing_exponent=settings.red_pacing_exponent,
+                             media_cache=media_cache,
+                             phash_dedup=settings.red_phash_dedup,
+                             phash_distance=settings.red_phash_distance,
+                             phash_ttl=settings.red_phash_ttl,
+                             listing_mode=settings.red_listing_mode,
+                             poll_interval=settings.red_poll_interval,
+                             min_score=settings.red_min_score,
+                             min_velocity=settings.red_min_velocity,
+                             media_optimizer=media_optimizer,
+                             prefetch_lead=settings.red_prefetch_lead,
+                             tmp_space=tmp_space,
+                             durable_send=settings.red_durable_send) as reddit:
             while reddit.is_running():
                 time.sleep(10)
+            # Shared media optimizer and tmp space are stopped together with the router
+            reddit.stop()
 
 
 if __name__ == "__main__":
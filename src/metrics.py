@@ -0,0 +1,223 @@
+"""This module contains objects collecting performance metrics of the reposting pipeline and rendering them in the
+Prometheus text exposition format. Metrics are kept in process memory, recording a value takes a lock and a few
+additions, so the instrumentation stays enabled in production."""
+from bisect import bisect_left
+import math
+from redis import Redis
+from redis.client import Pipeline
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(value)
+
+
+def format_metric(name: str,
+                  metric_type: str,
+                  documentation: str,
+                  samples: Iterable[Tuple[Dict[str, str], float]]) -> str:
+    """Render a metric computed at scrape time.
+
+    Args:
+        name: Metric name.
+        metric_type: 'counter' or 'gauge'.
+        documentation: Metric description.
+        samples: (labels, value) tuples.
+    Returns:
+        str: Metric in the Prometheus text format.
+    """
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+    lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        """Initialize Counter object.
+
+        Args:
+            name: Metric name.
+            documentation: Metric description.
+            label_names: Names of the labels every value is recorded with.
+        """
+        self._name = name
+        self._documentation = documentation
+        self._label_names = label_names
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increase the counter.
+
+        Args:
+            amount: Value to add.
+            **labels: Label values, one per label name.
+        """
+        key = tuple(labels[x] for x in self._label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> str:
+        """Render the counter in the Prometheus text format."""
+        with self._lock:
+            values = dict(self._values)
+        return format_metric(self._name, 'counter', self._documentation,
+                             ((dict(zip(self._label_names, key)), value) for key, value in sorted(values.items())))
+
+
+class Histogram:
+    """Counts of observed values falling into buckets of upper bounds, with the sum of the values, per label set."""
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """Initialize Histogram object.
+
+        Args:
+            name: Metric name.
+            documentation: Metric description.
+            label_names: Names of the labels every value is observed with.
+            buckets: Sorted upper bounds of the buckets. The +Inf bucket is added implicitly.
+        """
+        self._name = name
+        self._documentation = documentation
+        self._label_names = label_names
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Label values -> [per bucket counts, including +Inf, sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Record a value.
+
+        Args:
+            value: Observed value, e.g. a duration in seconds.
+            **labels: Label values, one per label name.
+        """
+        key = tuple(labels[x] for x in self._label_names)
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> str:
+        """Render the histogram in the Prometheus text format."""
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+        lines = [f'# HELP {self._name} {self._documentation}', f'# TYPE {self._name} histogram']
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self._label_names, key))
+            cumulative = 0
+            for bound, count in zip(self._buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self._name}_bucket{_format_labels({**labels, "le": _format_value(bound)})} '
+                             f'{cumulative}')
+            lines.append(f'{self._name}_sum{_format_labels(labels)} {_format_value(total)}')
+            lines.append(f'{self._name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: List[object] = []
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        """Create and register a Counter object. See Counter for the arguments."""
+        metric = Counter(name, documentation, label_names)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        """Create and register a Histogram object. See Histogram for the arguments."""
+        metric = Histogram(name, documentation, label_names, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render all the registered metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(x.render() for x in metrics)
+
+
+class InstrumentedPipeline(Pipeline):
+    """Redis pipeline recording the round-trip time of every execution."""
+
+    def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - start, command='pipeline')
+
+
+class InstrumentedRedis(Redis):
+    """Redis client recording the round-trip time of every command and pipeline execution."""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - start, command=str(args[0]).lower())
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+REGISTRY = MetricsRegistry()
+
+REDDIT_REQUEST_SECONDS = REGISTRY.histogram('reposter_reddit_request_seconds',
+                                            'Latency of Reddit listing requests.',
+                                            ('listing',))
+DOWNLOAD_SECONDS = REGISTRY.histogram('reposter_download_seconds',
+                                      'Time to download a media file, from the request to the last streamed chunk.',
+                                      ('host',))
+DOWNLOAD_BYTES = REGISTRY.counter('reposter_download_bytes_total',
+                                  'Downloaded media bytes.',
+                                  ('host',))
+FFMPEG_MUX_SECONDS = REGISTRY.histogram('reposter_ffmpeg_mux_seconds',
+                                        'Time to mux Reddit video and audio tracks with ffmpeg.',
+                                        ('mode',))
+TDLIB_SEND_SECONDS = REGISTRY.histogram('reposter_tdlib_send_seconds',
+                                        'Time from sending a message request to TDLib to updateMessageSendSucceeded '
+                                        'or updateMessageSendFailed.',
+                                        ('result',))
+REDIS_SECONDS = REGISTRY.histogram('reposter_redis_seconds',
+                                   'Round-trip time of Redis commands and pipelines.',
+                                   ('command',),
+                                   REDIS_BUCKETS)
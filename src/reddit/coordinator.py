@@ -0,0 +1,165 @@
+"""This module contains a WorkerCoordinator object. This object registers a reposter worker in Redis and splits routes
+between the live workers with consistent hashing."""
+from bisect import bisect
+import hashlib
+import logging
+import os
+from redis import Redis
+from redis.exceptions import RedisError
+import socket
+import threading
+from typing import Callable, List, Optional
+
+
+class WorkerCoordinator:
+    """Keeps a lease of this worker in Redis and tracks the other live workers. Every route is owned by a single live
+    worker, chosen on a consistent hash ring, so adding or removing a worker moves only a part of the routes. A worker
+    which stops renewing its lease is dropped from the ring after lease_ttl seconds and its routes fail over to the
+    remaining workers."""
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def _heartbeat(self):
+        logging.debug("Worker coordinator thread started.")
+        while not self._stop_event.wait(self._heartbeat_interval):
+            try:
+                self._renew_lease()
+            except RedisError:
+                logging.exception(f"Worker {self._worker_id} failed to renew its lease.")
+
+    def _notify_subscribers(self):
+        # Callbacks may take longer than the lease, e.g. starting and stopping browsers, so they are run on a separate
+        # thread. Changes made while the callbacks run are coalesced into one more notification.
+        logging.debug("Worker coordinator notification thread started.")
+        while True:
+            self._changed.wait()
+            if self._stop_event.is_set():
+                break
+            self._changed.clear()
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception(f"Worker set change callback {callback} failed.")
+
+    def _now(self) -> float:
+        # Redis server time is used, so the leases do not depend on clock skew between the nodes
+        seconds, microseconds = self._redis.time()
+        return seconds + microseconds / 10 ** 6
+
+    def _renew_lease(self):
+        now = self._now()
+        with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._workers_key, {self._worker_id: now + self._lease_ttl})
+            pipe.zremrangebyscore(self._workers_key, '-inf', now)
+            pipe.zrangebyscore(self._workers_key, now, '+inf')
+            workers = sorted(x.decode('utf-8') for x in pipe.execute()[-1])
+
+        with self._lock:
+            if workers == self._workers:
+                return
+            logging.info(f"Live workers changed from {self._workers} to {workers}.")
+            self._workers = workers
+            self._ring = sorted((WorkerCoordinator._hash(f'{worker}#{i}'), worker)
+                                for worker in workers for i in range(self._virtual_nodes))
+        self._changed.set()
+
+    def __init__(self,
+                 redis_db: Redis,
+                 worker_id: Optional[str] = None,
+                 lease_ttl: int = 30,
+                 virtual_nodes: int = 64,
+                 db_key_prefix: str = 'reposter'):
+        """Initialize WorkerCoordinator object. The worker is registered before the constructor returns.
+
+        Args:
+            redis_db: Redis DB instance shared by all the workers.
+            worker_id: Unique name of this worker. If None - host name and process ID are used.
+            lease_ttl: Time in seconds after which a worker not renewing its lease is considered dead. The lease is
+                renewed every third of this time.
+            virtual_nodes: Number of points of every worker on the hash ring. More points - more even split.
+            db_key_prefix: DB key prefix of the workers registry.
+        """
+        logging.debug("Creating class WorkerCoordinator object.")
+        self._redis = redis_db
+        self._worker_id = worker_id if worker_id is not None else f'{socket.gethostname()}-{os.getpid()}'
+        self._lease_ttl = lease_ttl
+        self._heartbeat_interval = max(1.0, lease_ttl / 3)
+        self._virtual_nodes = max(1, virtual_nodes)
+        self._workers_key = f'{db_key_prefix}_workers'
+
+        self._lock = threading.Lock()
+        self._workers: List[str] = []
+        self._ring = []
+        self._subscribers: List[Callable[[], None]] = []
+        self._changed = threading.Event()
+        self._renew_lease()
+        logging.info(f"Worker {self._worker_id} registered.")
+
+        self._stop_event = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, args=(), name='WorkerCoordinator')
+        self._heartbeat_thread.start()
+        self._notify_thread = threading.Thread(target=self._notify_subscribers, args=(),
+                                               name='WorkerCoordinatorNotify')
+        self._notify_thread.start()
+
+    def is_running(self) -> bool:
+        """Returns True if the worker lease is being renewed."""
+        return not self._stop_event.is_set()
+
+    def owner(self, key: str) -> Optional[str]:
+        """Get the live worker owning a key.
+
+        Args:
+            key: Key of a route.
+        Returns:
+            str or None: ID of the owning worker. None if no worker is alive.
+        """
+        with self._lock:
+            if len(self._ring) == 0:
+                return None
+            index = bisect(self._ring, (WorkerCoordinator._hash(key), '')) % len(self._ring)
+            return self._ring[index][1]
+
+    def owns(self, key: str) -> bool:
+        """Returns True if this worker owns a key."""
+        return self.owner(key) == self._worker_id
+
+    def stop(self):
+        """Stop renewing the lease and deregister the worker, so its routes fail over immediately."""
+        logging.debug(f"Stopping WorkerCoordinator object.")
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._changed.set()
+        self._heartbeat_thread.join()
+        self._notify_thread.join()
+        try:
+            self._redis.zrem(self._workers_key, self._worker_id)
+        except RedisError:
+            logging.exception(f"Worker {self._worker_id} failed to deregister.")
+
+    def subscribe_workers_changed(self, callback: Callable[[], None]):
+        """Subscribe to live workers set changes. The callback is run on the coordinator notification thread, so a
+        slow callback does not delay the lease renewal."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe_workers_changed(self, callback: Callable[[], None]):
+        """Unsubscribe from live workers set changes."""
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    @property
+    def worker_id(self) -> str:
+        return self._worker_id
+
+    @property
+    def workers(self) -> List[str]:
+        """IDs of the live workers."""
+        with self._lock:
+            return list(self._workers)
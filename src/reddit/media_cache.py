@@ -0,0 +1,194 @@
+"""This module contains a MediaCache object. This object keeps downloaded media on disk, addressed by content hash, so
+media reposted under new submission IDs or linked from several subreddits is not downloaded again."""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class MediaCache:
+    """A size bounded, least recently used media cache. Cached files are stored as {content hash}.{extension} and are
+    looked up by the canonical URL they were downloaded from. The same content downloaded from another URL is stored
+    once. Files handed out by the cache are hard links to the cached copy, so removing them after sending does not
+    affect the cache and no data is copied.
+
+    The files handed out must not be modified in place. They share the data with the cached copy."""
+
+    hash_chunk_size = 1024 * 1024  # bytes
+    max_tracked_paths = 4096  # handed out files remembered with their content hash
+
+    @staticmethod
+    def _canonical_url(url: str) -> str:
+        # Query and fragment differ between links to the same asset, e.g. v.redd.it '?source=fallback'
+        parts = urlsplit(url)
+        return f"{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path}"
+
+    @staticmethod
+    def _file_hash(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(MediaCache.hash_chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _link(src_path: str, dst_path: str):
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            # Hard links are not possible across file systems
+            shutil.copyfile(src_path, dst_path)
+
+    def _evict(self):
+        # Must be called with self._lock acquired
+        while self._size > self._max_size and len(self._entries) > 0:
+            content_hash, (cached_path, file_size) = self._entries.popitem(last=False)
+            self._size -= file_size
+            self._evicted += 1
+            logging.debug(f"Evicting {cached_path} from media cache.")
+            try:
+                os.remove(cached_path)
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        # Files of the previous run are restored in modification time order, the URL index is not persisted
+        files = []
+        for entry in os.scandir(self._cache_dir):
+            content_hash, _ = os.path.splitext(entry.name)
+            if entry.is_file() and len(content_hash) == 64:
+                stat = entry.stat()
+                files.append((stat.st_mtime, content_hash, entry.path, stat.st_size))
+        for _, content_hash, cached_path, file_size in sorted(files):
+            self._entries[content_hash] = (cached_path, file_size)
+            self._size += file_size
+        self._evict()
+        logging.debug(f"Media cache loaded {len(self._entries)} files, {self._size} bytes.")
+
+    def _track_path(self, file_path: str, content_hash: str):
+        # Must be called with self._lock acquired
+        self._path_hashes[file_path] = content_hash
+        self._path_hashes.move_to_end(file_path)
+        while len(self._path_hashes) > MediaCache.max_tracked_paths:
+            self._path_hashes.popitem(last=False)
+
+    def __init__(self, cache_dir: str, max_size: int = 1024 * 1024 * 1024):
+        """Initialize MediaCache object.
+
+        Args:
+            cache_dir: Directory to store the cached files in. Should be on the same file system as the download
+                directory, otherwise the files are copied instead of hard linked.
+            max_size: Max total size of the cached files in bytes. The least recently used files are evicted first.
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[str, int]] = OrderedDict()
+        self._urls: Dict[str, str] = {}
+        self._path_hashes: Dict[str, str] = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+        self._load()
+
+    def content_hash(self, file_path: str) -> str:
+        """Get the content hash of a file. Files handed out or stored by the cache are not read again.
+
+        Args:
+            file_path: Path to the file.
+        Returns:
+            str: SHA-256 hex digest of the file content.
+        """
+        with self._lock:
+            content_hash = self._path_hashes.get(file_path)
+        return content_hash if content_hash is not None else MediaCache._file_hash(file_path)
+
+    def get(self, url: str, file_path: str) -> Optional[str]:
+        """Get a cached file downloaded from a URL.
+
+        Args:
+            url: URL the file would be downloaded from.
+            file_path: Location to put the file to, without extension.
+        Returns:
+            str or None: Actual location of the file. None if the URL is not cached.
+        """
+        with self._lock:
+            content_hash = self._urls.get(MediaCache._canonical_url(url))
+            entry = self._entries.get(content_hash) if content_hash is not None else None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(content_hash)
+            self._hits += 1
+
+            cached_path, _ = entry
+            # Modification time keeps the recency order across restarts
+            os.utime(cached_path)
+            new_name = f"{file_path}{os.path.splitext(cached_path)[1]}"
+            # Linking under the lock, so the cached file is not evicted meanwhile
+            MediaCache._link(cached_path, new_name)
+            self._track_path(new_name, content_hash)
+
+        logging.debug(f"Media cache hit for {url}: {new_name}")
+        return new_name
+
+    def put(self, url: str, file_path: str):
+        """Store a downloaded file in the cache. If the same content is already cached, only the URL is recorded.
+
+        Args:
+            url: URL the file was downloaded from.
+            file_path: Path to the downloaded file. The file is left in place.
+        """
+        content_hash = MediaCache._file_hash(file_path)
+        file_size = os.path.getsize(file_path)
+        with self._lock:
+            self._urls[MediaCache._canonical_url(url)] = content_hash
+            self._track_path(file_path, content_hash)
+            if content_hash in self._entries:
+                self._entries.move_to_end(content_hash)
+                logging.debug(f"Content of {url} is already cached.")
+                return
+            if file_size > self._max_size:
+                return
+
+            cached_path = os.path.join(self._cache_dir, f"{content_hash}{os.path.splitext(file_path)[1]}")
+            try:
+                MediaCache._link(file_path, cached_path)
+            except OSError as e:
+                logging.error(f"Failed to cache {file_path}: {e}")
+                return
+            self._entries[content_hash] = (cached_path, file_size)
+            self._size += file_size
+            self._evict()
+
+            # URLs of evicted content are pruned once the URL index grows large
+            if len(self._urls) > 4 * len(self._entries) + MediaCache.max_tracked_paths:
+                self._urls = {k: v for k, v in self._urls.items() if v in self._entries}
+
+    def stats(self) -> Dict[str, int]:
+        """Get cache statistics.
+
+        Returns:
+            A dictionary containing next keys:
+                'entries' - number of cached files.
+                'size'    - total size of the cached files in bytes.
+                'hits'    - number of lookups served from the cache.
+                'misses'  - number of lookups not found in the cache.
+                'evicted' - number of evicted files.
+        """
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'size': self._size,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evicted': self._evicted}
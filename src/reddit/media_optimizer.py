@@ -0,0 +1,123 @@
+"""This module contains a MediaOptimizer object. This object shrinks media before it is uploaded to Telegram: GIFs are
+converted to H.264 MP4, oversized images are downscaled and large videos are re-encoded."""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import subprocess
+import time
+from typing import List, Optional, Tuple
+
+
+class MediaOptimizer:
+    """Optimizes media files with ffmpeg. Every optimization runs in a separate ffmpeg process, the number of concurrent
+    processes is limited by the number of workers. An optimized file is kept only if it is smaller than the original.
+
+    MP4 files converted from GIFs are named *.gif.mp4, so they are still sent as animations."""
+
+    animation_suffix = '.gif.mp4'
+    timeout = 300  # sec
+
+    @staticmethod
+    def _image_dimensions(file_path: str) -> Optional[Tuple[int, int]]:
+        try:
+            result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                     '-show_entries', 'stream=width,height', '-of', 'csv=p=0', file_path],
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, timeout=MediaOptimizer.timeout)
+            width, height = result.stdout.decode('utf-8').strip().split(',')[:2]
+            return int(width), int(height)
+        except (OSError, subprocess.TimeoutExpired, ValueError):
+            return None
+
+    def _optimize_file(self, file_path: str) -> Tuple[str, int, int, float]:
+        start = time.perf_counter()
+        original_size = os.path.getsize(file_path)
+        base_path, ext = os.path.splitext(file_path)
+        ext = ext[1:].lower()
+
+        args = None
+        out_file = None
+        if ext == 'gif' and self._gif_to_mp4:
+            out_file = f'{base_path}{MediaOptimizer.animation_suffix}'
+            # H.264 with yuv420p requires even dimensions
+            args = ['-movflags', '+faststart', '-pix_fmt', 'yuv420p', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-an']
+
+        elif ext in ('jpg', 'jpeg', 'png'):
+            dimensions = MediaOptimizer._image_dimensions(file_path)
+            if original_size > self._max_image_size or \
+                    (dimensions is not None and max(dimensions) > self._max_image_side):
+                out_file = f'{base_path}_opt.jpg'
+                side = self._max_image_side
+                args = ['-vf', f"scale='min({side},iw)':'min({side},ih)':force_original_aspect_ratio=decrease",
+                        '-q:v', '3']
+
+        elif ext in ('mp4', 'webm', 'avi') and not file_path.endswith(MediaOptimizer.animation_suffix) and \
+                original_size > self._max_video_size:
+            out_file = f'{base_path}_opt.mp4'
+            args = ['-movflags', '+faststart', '-pix_fmt', 'yuv420p',
+                    '-vf', f"scale='min({self._max_video_width},iw)':-2",
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-c:a', 'aac', '-b:a', '128k']
+
+        if args is None:
+            return file_path, original_size, original_size, time.perf_counter() - start
+
+        if self._run_ffmpeg(file_path, args, out_file):
+            optimized_size = os.path.getsize(out_file)
+            if optimized_size < original_size:
+                logging.debug(f"Optimized {file_path} from {original_size} to {optimized_size} bytes.")
+                os.remove(file_path)
+                return out_file, original_size, optimized_size, time.perf_counter() - start
+        if os.path.isfile(out_file):
+            os.remove(out_file)
+        return file_path, original_size, original_size, time.perf_counter() - start
+
+    @staticmethod
+    def _run_ffmpeg(in_file: str, args: List[str], out_file: str) -> bool:
+        try:
+            result = subprocess.run(['ffmpeg', '-loglevel', 'panic', '-y', '-i', in_file] + args + [out_file],
+                                    stdin=subprocess.DEVNULL, timeout=MediaOptimizer.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error(f"Failed to optimize {in_file}: {e}")
+            return False
+        return result.returncode == 0 and os.path.isfile(out_file)
+
+    def __init__(self,
+                 workers: int = 2,
+                 gif_to_mp4: bool = True,
+                 max_image_side: int = 2560,
+                 max_image_size: int = 5 * 1024 * 1024,
+                 max_video_size: int = 20 * 1024 * 1024,
+                 max_video_width: int = 1280):
+        """Initialize MediaOptimizer object.
+
+        Args:
+            workers: Max number of files optimized concurrently.
+            gif_to_mp4: If True - GIFs are converted to H.264 MP4.
+            max_image_side: Images with a longer side are downscaled to it.
+            max_image_size: Images larger than this size in bytes are re-encoded to JPEG.
+            max_video_size: Videos larger than this size in bytes are re-encoded.
+            max_video_width: Re-encoded videos are downscaled to this width.
+        """
+        self._gif_to_mp4 = gif_to_mp4
+        self._max_image_side = max_image_side
+        self._max_image_size = max_image_size
+        self._max_video_size = max_video_size
+        self._max_video_width = max_video_width
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='MediaOptimizer')
+
+    def optimize(self, file_path: str) -> Tuple[str, int, int, float]:
+        """Optimize a media file. Blocks until the optimization is finished. The original file is removed if an
+        optimized one is created.
+
+        Args:
+            file_path: Path to the media file.
+        Returns:
+            Tuple of the resulting file path, the original size in bytes, the resulting size in bytes and the time in
+            seconds spent.
+        """
+        return self._pool.submit(self._optimize_file, file_path).result()
+
+    def stop(self):
+        """Wait for the running optimizations and stop the workers."""
+        logging.debug(f"Stopping MediaOptimizer object.")
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,185 @@
+"""This module contains objects used to detect reposts of the same picture or video under new submission IDs. Media is
+reduced to 64-bit difference hashes (dHash), which stay close in Hamming distance after re-encoding, resizing or
+re-watermarking, and the hashes already posted to a channel are indexed for Hamming distance lookups."""
+import logging
+from redis import Redis
+import subprocess
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+class PerceptualHash:
+    """Computes difference hashes of images and of keyframes of videos and GIFs with ffmpeg."""
+
+    hash_width = 8
+    hash_height = 8
+    min_bits = 4  # hashes of nearly uniform frames, e.g. black intro frames, match everything and are dropped
+    timeout = 30  # sec
+
+    @staticmethod
+    def distance(hash_a: int, hash_b: int) -> int:
+        """Get the Hamming distance between two hashes."""
+        return (hash_a ^ hash_b).bit_count()
+
+    @staticmethod
+    def frame_hashes(file_path: str, max_frames: int = 3) -> List[int]:
+        """Compute dHash of an image or of the first keyframes of a video.
+
+        Args:
+            file_path: Path to an image, a GIF or a video file.
+            max_frames: Max number of keyframes hashed.
+        Returns:
+            List of 64-bit hashes. Empty if the file could not be decoded.
+        """
+        frame_size = (PerceptualHash.hash_width + 1) * PerceptualHash.hash_height
+        # Every frame is downscaled to 9x8 grayscale pixels by ffmpeg, only keyframes are decoded
+        try:
+            result = subprocess.run(['ffmpeg', '-loglevel', 'panic',
+                                     '-skip_frame', 'nokey',
+                                     '-i', file_path,
+                                     '-vf', f'scale={PerceptualHash.hash_width + 1}:{PerceptualHash.hash_height}'
+                                            f':flags=area,format=gray',
+                                     '-fps_mode', 'passthrough',
+                                     '-frames:v', str(max_frames),
+                                     '-f', 'rawvideo', '-'],
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    timeout=PerceptualHash.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error(f"Failed to hash {file_path}: {e}")
+            return []
+
+        hashes = []
+        pixels = result.stdout
+        for offset in range(0, len(pixels) - frame_size + 1, frame_size):
+            frame_hash = 0
+            for row in range(PerceptualHash.hash_height):
+                row_start = offset + row * (PerceptualHash.hash_width + 1)
+                for col in range(PerceptualHash.hash_width):
+                    frame_hash = (frame_hash << 1) | (pixels[row_start + col] > pixels[row_start + col + 1])
+            if PerceptualHash.min_bits <= frame_hash.bit_count() <= 64 - PerceptualHash.min_bits:
+                hashes.append(frame_hash)
+        return hashes
+
+
+class HammingIndex:
+    """An index of 64-bit hashes finding all the hashes within a Hamming distance. Hashes are split into
+    max_distance + 1 disjoint bit ranges and indexed by every range. Two hashes differing in at most max_distance bits
+    have at least one range equal, so only the hashes sharing a range with the looked up one are compared."""
+
+    def __init__(self, max_distance: int = 6):
+        """Initialize HammingIndex object.
+
+        Args:
+            max_distance: Max Hamming distance of a match.
+        """
+        self._max_distance = max_distance
+        parts = min(64, max_distance + 1)
+        self._ranges = []
+        shift = 0
+        for i in range(parts):
+            width = 64 // parts + (1 if i < 64 % parts else 0)
+            self._ranges.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._ranges]
+        self._hashes = set()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, value: int):
+        """Add a hash to the index. Adding an already stored hash does nothing."""
+        if value in self._hashes:
+            return
+        self._hashes.add(value)
+        for table, (shift, mask) in zip(self._tables, self._ranges):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def search(self, value: int) -> List[Tuple[int, int]]:
+        """Find the stored hashes within max_distance.
+
+        Args:
+            value: Hash to look up.
+        Returns:
+            List of (distance, hash) tuples sorted by distance.
+        """
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, self._ranges):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        matches = [(PerceptualHash.distance(value, x), x) for x in candidates]
+        return sorted(x for x in matches if x[0] <= self._max_distance)
+
+
+class PerceptualHashIndex:
+    """Hashes of the media posted to a channel. The hashes are stored in a Redis sorted set scored by post time, so they
+    survive restarts and are shared between workers, and mirrored to a local HammingIndex for lookups."""
+
+    def _sync(self):
+        # Must be called with self._lock acquired. Only the hashes added since the last sync are fetched.
+        entries = self._redis.zrangebyscore(self._db_key, self._synced, '+inf', withscores=True)
+        for member, score in entries:
+            self._table.add(int(member, 16))
+            self._synced = max(self._synced, score)
+
+    def __init__(self, redis_db: Redis, db_key_prefix: str, max_distance: int = 6):
+        """Initialize PerceptualHashIndex object.
+
+        Args:
+            redis_db: Redis DB instance.
+            db_key_prefix: DB key prefix of the channel.
+            max_distance: Max Hamming distance between hashes of the same media.
+        """
+        self._redis = redis_db
+        self._db_key = f'{db_key_prefix}_phashes'
+        self._max_distance = max_distance
+        self._lock = threading.Lock()
+        self._table = HammingIndex(max_distance)
+        self._synced = 0
+        with self._lock:
+            self._sync()
+        logging.debug(f"Loaded {len(self._table)} perceptual hashes from {self._db_key}.")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._table)
+
+    def add(self, hashes: List[int]):
+        """Add hashes of a posted media.
+
+        Args:
+            hashes: Hashes returned by PerceptualHash.frame_hashes.
+        """
+        if len(hashes) == 0:
+            return
+        with self._lock:
+            self._redis.zadd(self._db_key, {f'{x:016x}': time.time() for x in hashes})
+            for frame_hash in hashes:
+                self._table.add(frame_hash)
+
+    def cleanup(self, older_than: float):
+        """Remove hashes added before a point in time.
+
+        Args:
+            older_than: Unix timestamp.
+        """
+        with self._lock:
+            if self._redis.zremrangebyscore(self._db_key, '-inf', older_than) > 0:
+                # The index is rebuilt from the remaining hashes, removal is rare
+                self._table = HammingIndex(self._max_distance)
+                self._synced = 0
+                self._sync()
+
+    def find(self, hashes: List[int]) -> Optional[Tuple[int, int]]:
+        """Find the closest posted media.
+
+        Args:
+            hashes: Hashes returned by PerceptualHash.frame_hashes.
+        Returns:
+            (distance, hash) tuple of the closest match within max_distance of any of the hashes. None if not found.
+        """
+        if len(hashes) == 0:
+            return None
+        with self._lock:
+            self._sync()
+            matches = [match for x in hashes for match in self._table.search(x)]
+        return min(matches) if len(matches) > 0 else None
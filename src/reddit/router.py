@@ -0,0 +1,246 @@
+"""This module contains a SubredditRouter object. This object serves multiple subreddit to Telegram channel routes in a
+single process, sharing one Reddit client and one Telegram client between them."""
+import logging
+import praw
+from reddit.coordinator import WorkerCoordinator
+from reddit.subreddit_browser import ListingCache, SubredditBrowser
+from redis import Redis
+from stats import StatCollector
+from telegram.telegram_wrapper import TelegramWrapper
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class SubredditRouter:
+    """This object serves N subreddit to Telegram channel routes with a single Reddit client and a single Telegram
+    client. Every route is browsed by its own SubredditBrowser and keeps a separate Redis namespace.
+
+    With a WorkerCoordinator, the routes are split between the reposter workers sharing the Redis DB, and only the
+    routes owned by this worker are browsed. The routes are rebalanced every time a worker joins or leaves."""
+
+    def _rebalance(self):
+        # Browsers are started and stopped outside the routes lock, stopping a browser waits for its thread
+        with self._routes_lock:
+            owned = [x for x in self._routes if self._owns(x)]
+            to_stop = [(x, self._browsers.pop(x)) for x in list(self._browsers) if x not in owned]
+            to_start = [x for x in owned if x not in self._browsers]
+
+        for (subreddit_name, telegram_channel), browser in to_stop:
+            logging.info(f"Route r/{subreddit_name} -> {telegram_channel} moved to another worker.")
+            browser.stop()
+
+        for route in to_start:
+            self._start_browser(route)
+
+    def _owns(self, route: Tuple[str, str]) -> bool:
+        return self._coordinator is None or self._coordinator.owns(f"{route[0]}_{route[1]}")
+
+    def _start_browser(self, route: Tuple[str, str]):
+        with self._routes_lock:
+            if route in self._browsers or route in self._starting:
+                return
+            self._starting.add(route)
+
+        subreddit_name, telegram_channel = route
+        logging.info(f"Browsing route r/{subreddit_name} -> {telegram_channel}.")
+        try:
+            browser = SubredditBrowser(reddit_creds=None,
+                                       praw_core=self._praw_core,
+                                       listing_cache=self._listing_cache,
+                                       subreddit_name=subreddit_name,
+                                       telegram_wrap=self._telegram_wrap,
+                                       telegram_channel=telegram_channel,
+                                       redis_db=self._redis,
+                                       stat_collector=self._stat_collectors[route],
+                                       **self._browser_kwargs)
+        finally:
+            with self._routes_lock:
+                self._starting.discard(route)
+
+        with self._routes_lock:
+            # The route might have been removed or moved to another worker while the browser was being created
+            if route in self._routes and self._owns(route):
+                self._browsers[route] = browser
+                browser = None
+        if browser is not None:
+            browser.stop()
+
+    def __del__(self):
+        logging.debug(f"Deleting SubredditRouter object.")
+        self._browsers = None
+        self._stat_collectors = None
+        self._praw_core = None
+        self._listing_cache = None
+        self._coordinator = None
+        self._telegram_wrap = None
+        self._redis = None
+        logging.debug(f"SubredditRouter object deleted.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __init__(self,
+                 reddit_creds: map,
+                 routes: List[Tuple[str, str]],
+                 telegram_wrap: TelegramWrapper,
+                 redis_db: Redis,
+                 stat_collector_factory: Callable[[str], StatCollector],
+                 listing_ttl: int = 300,
+                 coordinator: Optional[WorkerCoordinator] = None,
+                 **browser_kwargs):
+        """Initialize SubredditRouter object.
+
+        Args:
+            reddit_creds: A map of reddit credentials. See SubredditBrowser for details.
+            routes: A list of (subreddit name, telegram channel name) routes.
+            telegram_wrap: Telegram client wrapper shared by all the routes.
+            redis_db: Redis DB instance.
+            stat_collector_factory: Function returning a StatCollector object for a DB key prefix of a route.
+            listing_ttl: Time in seconds a fetched subreddit listing is reused by other routes of the same subreddit.
+            coordinator: WorkerCoordinator object splitting the routes between workers. If None - all the routes are
+                browsed by this process. The coordinator is stopped together with the router.
+            **browser_kwargs: Keyword arguments passed to every SubredditBrowser, e.g. top_num or browse_delay. Shared
+                media_optimizer and tmp_space are stopped together with the router.
+        """
+        logging.debug("Creating class SubredditRouter object.")
+        self._praw_core = praw.Reddit(client_id=reddit_creds['client_id'],
+                                      client_secret=reddit_creds['client_secret'],
+                                      password=reddit_creds['password'],
+                                      username=reddit_creds['username'],
+                                      user_agent=reddit_creds['user_agent'])
+        logging.info("Reddit login OK.")
+
+        self._listing_cache = ListingCache(listing_ttl)
+        self._telegram_wrap = telegram_wrap
+        self._redis = redis_db
+        self._stat_collector_factory = stat_collector_factory
+        self._browser_kwargs = browser_kwargs
+        self._coordinator = coordinator
+
+        self._routes_lock = threading.Lock()
+        self._routes: List[Tuple[str, str]] = []
+        self._browsers: Dict[Tuple[str, str], SubredditBrowser] = {}
+        self._starting = set()
+        self._stat_collectors: Dict[Tuple[str, str], StatCollector] = {}
+        for subreddit_name, telegram_channel in routes:
+            self.add_route(subreddit_name, telegram_channel)
+
+        if self._coordinator is not None:
+            self._coordinator.subscribe_workers_changed(self._rebalance)
+            # The worker set might have changed before the subscription
+            self._rebalance()
+
+    @property
+    def active_routes(self) -> List[Tuple[str, str]]:
+        """A list of the routes browsed by this worker."""
+        with self._routes_lock:
+            return list(self._browsers.keys())
+
+    def add_route(self, subreddit_name: str, telegram_channel: str):
+        """Start reposting a subreddit to a Telegram channel. In distributed mode the route is browsed only if owned by
+        this worker.
+
+        Args:
+            subreddit_name: A subreddit to browse.
+            telegram_channel: Name of the telegram channel to post into.
+        """
+        route = (subreddit_name, telegram_channel)
+        with self._routes_lock:
+            if route in self._routes:
+                return
+
+            logging.info(f"Adding route r/{subreddit_name} -> {telegram_channel}.")
+            self._stat_collectors[route] = self._stat_collector_factory(f"{subreddit_name}_{telegram_channel}")
+            self._routes.append(route)
+
+        if self._owns(route):
+            self._start_browser(route)
+
+    def api_calls_per_hour(self) -> int:
+        """Returns the number of Reddit API requests made by all the routes in the last hour."""
+        with self._routes_lock:
+            return sum(x.api_calls_per_hour() for x in self._browsers.values())
+
+    @property
+    def browse_delay(self) -> int:
+        with self._routes_lock:
+            return max([x.browse_delay for x in self._browsers.values()],
+                       default=self._browser_kwargs.get('browse_delay', 0))
+
+    @browse_delay.setter
+    def browse_delay(self, value: int):
+        with self._routes_lock:
+            for browser in self._browsers.values():
+                browser.browse_delay = value
+            self._browser_kwargs['browse_delay'] = value
+
+    def get_stat_collector(self, subreddit_name: str, telegram_channel: str) -> StatCollector:
+        """Get the StatCollector object of a route.
+
+        Args:
+            subreddit_name: Subreddit of the route.
+            telegram_channel: Telegram channel of the route.
+        Returns:
+            StatCollector: Statistics of the route.
+        """
+        with self._routes_lock:
+            return self._stat_collectors[(subreddit_name, telegram_channel)]
+
+    def is_running(self) -> bool:
+        """Returns True if at least one route is being browsed, or, in distributed mode, the worker is registered."""
+        with self._routes_lock:
+            browsing = any(x.is_running() for x in self._browsers.values())
+        return browsing or (self._coordinator is not None and self._coordinator.is_running())
+
+    def remove_route(self, subreddit_name: str, telegram_channel: str):
+        """Stop reposting a subreddit to a Telegram channel.
+
+        Args:
+            subreddit_name: Subreddit of the route.
+            telegram_channel: Telegram channel of the route.
+        """
+        route = (subreddit_name, telegram_channel)
+        with self._routes_lock:
+            if route not in self._routes:
+                return
+            self._routes.remove(route)
+            browser = self._browsers.pop(route, None)
+            stat_collector = self._stat_collectors.pop(route)
+
+        logging.info(f"Removing route r/{subreddit_name} -> {telegram_channel}.")
+        if browser is not None:
+            browser.stop()
+        stat_collector.stop()
+
+    @property
+    def routes(self) -> List[Tuple[str, str]]:
+        """A list of (subreddit name, telegram channel name) routes of all the workers."""
+        with self._routes_lock:
+            return list(self._routes)
+
+    def stop(self):
+        """Stop browsing all the routes."""
+        logging.debug(f"Stopping SubredditRouter object.")
+        if self._coordinator is not None:
+            self._coordinator.unsubscribe_workers_changed(self._rebalance)
+            self._coordinator.stop()
+        for subreddit_name, telegram_channel in self.routes:
+            self.remove_route(subreddit_name, telegram_channel)
+        for shared in ('media_optimizer', 'tmp_space'):
+            if self._browser_kwargs.get(shared) is not None:
+                self._browser_kwargs[shared].stop()
+
+    @property
+    def top_entries(self) -> int:
+        with self._routes_lock:
+            return max([x.top_entries for x in self._browsers.values()], default=self._browser_kwargs.get('top_num', 0))
+
+    @top_entries.setter
+    def top_entries(self, value: int):
+        with self._routes_lock:
+            for browser in self._browsers.values():
+                browser.top_entries = value
+            self._browser_kwargs['top_num'] = value
@@ -0,0 +1,68 @@
+"""This module contains a SendQueue object. This object records the media sends of a channel in Redis until Telegram
+confirms the delivery, so the posts claimed as reposted are not lost if the process stops before they are delivered."""
+import logging
+from redis import Redis
+import time
+from typing import Dict, List, Tuple
+
+
+class SendQueue:
+    """A durable queue of pending sends stored in a Redis stream. An entry is added before a media message is handed to
+    Telegram and deleted once the delivery is confirmed. Entries left by a stopped or crashed process are replayed by
+    the next browser of the channel, so a post is delivered at least once: a message sent but not confirmed before
+    the stop is sent again."""
+
+    def __init__(self, redis_db: Redis, db_key_prefix: str):
+        """Initialize SendQueue object.
+
+        Args:
+            redis_db: Redis DB instance.
+            db_key_prefix: DB key prefix of the channel.
+        """
+        self._redis = redis_db
+        self._db_key = f'{db_key_prefix}_send_queue'
+
+    def __len__(self):
+        return self._redis.xlen(self._db_key)
+
+    def add(self, file_path: str, caption: str, chat: str, post_id: str, attempts: int = 0) -> str:
+        """Add a pending send.
+
+        Args:
+            file_path: Path to the media file.
+            caption: Message caption.
+            chat: Title of the target chat.
+            post_id: ID of the reposted submission, used to download the media again if the file is lost.
+            attempts: Number of times the send was already replayed.
+        Returns:
+            str: ID of the entry.
+        """
+        entry_id = self._redis.xadd(self._db_key, {'path': file_path,
+                                                   'caption': caption,
+                                                   'chat': chat,
+                                                   'post_id': post_id,
+                                                   'attempts': attempts})
+        return entry_id.decode('utf-8')
+
+    def complete(self, entry_id: str):
+        """Remove a delivered send.
+
+        Args:
+            entry_id: ID returned by add.
+        """
+        if self._redis.xdel(self._db_key, entry_id) == 0:
+            logging.debug(f"Send queue entry {entry_id} of {self._db_key} is already completed.")
+
+    def pending(self, min_age: float = 0) -> List[Tuple[str, Dict[str, str]]]:
+        """Get the pending sends in the order they were added.
+
+        Args:
+            min_age: Time in seconds since the entry was added. Younger entries are not returned.
+        Returns:
+            List of (entry ID, fields) tuples. Fields are 'path', 'caption', 'chat', 'post_id' and 'attempts'.
+        """
+        # Stream entry IDs start with the time the entry was added in milliseconds
+        max_id = int((time.time() - min_age) * 1000) if min_age > 0 else '+'
+        entries = self._redis.xrange(self._db_key, max=max_id)
+        return [(entry_id.decode('utf-8'), {k.decode('utf-8'): v.decode('utf-8') for k, v in fields.items()})
+                for entry_id, fields in entries]
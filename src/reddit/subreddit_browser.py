@@ -1,18 +1,30 @@
 """This module contains a SubredditBrowser object. This object is intended to browse "top" section of a single subreddit
 and repost its content to a Telegram community."""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+import errno
 import logging
+from metrics import FFMPEG_MUX_SECONDS, REDDIT_REQUEST_SECONDS
 import os
 import praw
 from prawcore.exceptions import ServerError, RequestException
 import re
+from reddit.media_cache import MediaCache
+from reddit.media_optimizer import MediaOptimizer
+from reddit.phash import PerceptualHash, PerceptualHashIndex
+from reddit.send_queue import SendQueue
+from reddit.tmp_space import TmpSpaceManager
 from redis import Redis
+import shutil
 from stats import StatCollector
 import subprocess
-from telegram.telegram_wrapper import TelegramWrapper
+import tempfile
+from telegram.telegram_wrapper import TelegramAlbumMediaType, TelegramMediaType, TelegramWrapper
 from telegram.utils import TelegramHelper
 import threading
 import time
-from typing import Optional
+from typing import BinaryIO, ContextManager, Dict, Iterable, List, Optional, Tuple
 from utils import DownloadManager
 
 
@@ -20,63 +32,460 @@ class SubredditBrowser:
     """This object is intended to browse a "top" section of a single subreddit and repost its content to a Telegram
     community."""
 
+    album_max_size = 10  # Telegram limit of media in a single album
+    candidate_max_age = 86400  # sec, posts not crossing the threshold in this time are not tracked any more
+    candidate_refresh_ratio = 0.1  # a candidate score is refreshed after this fraction of the post age passed
+    max_candidate_refresh = 100  # max candidates refreshed per listing poll, a single info request
+    max_send_replays = 3  # unconfirmed sends are dropped after being replayed this many times
+    send_replay_grace = 600  # sec, younger unconfirmed sends may still be in flight in another process
+
     def _browse_subreddit(self):
         logging.info("Subreddit browser thread started.")
         post = True
+        prefetched = False
         last_post_time = time.time()
+        last_poll_time = 0
+        last_replay_time = 0
+        prefetch_time = 0
         while not self._browse_stop.is_set():
+            if time.time() - last_replay_time > SubredditBrowser.send_replay_grace:
+                last_replay_time = time.time()
+                self._replay_sends()
+
             if post:
                 self._do_post_storage_cleanup()
                 last_post_time = time.time()
                 post = False
+                prefetched = False
+                logging.info(f"r/{self.subreddit_name}: {self._api_calls.per_hour()} Reddit API calls "
+                             f"in the last hour.")
+                if self._listing_mode == 'top':
+                    # Prefetched posts which dropped out of the listing are evicted, the others are already on disk
+                    prefetches, self._prefetches = self._prefetches, {}
+                    try:
+                        # The listing cached at the prefetch would hide the posts which dropped out of the top since
+                        submissions = self._fetch_top(fetched_after=prefetch_time)
+                        # Posts queued in the previous window are not posted yet, but should not be queued twice
+                        queued = {x.id for x, _ in self._post_queue}
+                        to_repost = [x for x in self._filter_posted(submissions) if x.id not in queued]
+
+                        # Media is downloaded concurrently, but the posts are sent in the original rank order
+                        self._queue_posts([(x, prefetches.pop(x.id, None) or
+                                            self._download_pool.submit(self._prepare_media, x))
+                                           for x in to_repost])
+                    except (ServerError, RequestException):
+                        logging.error("Reddit server error encountered. No reposts during this browse window.")
+                    self._evict_prefetches(prefetches.values())
+
+            if self._listing_mode == 'top' and self._prefetch_lead > 0 and not prefetched and \
+                    time.time() - last_post_time > self._browse_delay - self._prefetch_lead:
+                prefetched = True
+                self._prefetch()
+                prefetch_time = time.time()
+
+            if self._listing_mode != 'top' and time.time() - last_poll_time > self._poll_interval:
+                last_poll_time = time.time()
                 try:
-                    with self._subreddit_lock:
-                        submissions = self._subreddit.top('day', limit=self._top_num)
-                    for submission in submissions:
-                        if not self._redis.sismember(f'{self._db_key_prefix}_posted', submission.id):
-                            file_path = self._extractor.extract_media(submission)
-                            if file_path is not None:
-                                logging.debug(f'Reposting post ID: {submission.id} '
-                                              f'from {submission.subreddit.display_name} '
-                                              f'to {self._telegram_channel}.')
-
-                                self._redis.sadd(f'{self._db_key_prefix}_posted', submission.id)
-                                self._redis.hset(f'{self._db_key_prefix}_post_time', submission.id, time.time())
-                                self._telegram_wrap.send_media_message(file_path,
-                                                                       TelegramHelper.determine_media_type(file_path),
-                                                                       chat_title=self._telegram_channel,
-                                                                       caption=submission.title)
-                                self._stat_collector.record_media_sent(file_path)
-                                # self._telegram_wrap.send_text_message(submission.title,
-                                #                                       chat_title=self._telegram_channel)
+                    to_repost = self._filter_posted(self._poll_listing())
+                    self._post_queue.extend((x, self._download_pool.submit(self._prepare_media, x))
+                                            for x in to_repost)
                 except (ServerError, RequestException):
-                    logging.error("Reddit server error encountered. No reposts during this browse window.")
+                    logging.error("Reddit server error encountered. Skipping listing poll.")
+
+            self._post_due()
+            self._post_replays()
+            self._flush_album()
+            if time.time() - last_post_time > self._browse_delay:
+                post = True
+            else:
+                time.sleep(1)
+
+    def _client_lock(self) -> ContextManager:
+        # Requests through a Reddit client shared with other browsers are serialized by the listing cache
+        return self._listing_cache.client_lock if self._listing_cache is not None else nullcontext()
+
+    def _fetch_top(self, fetched_after: float = 0) -> List[praw.models.Submission]:
+        with self._subreddit_lock:
+            if self._listing_cache is not None:
+                return self._listing_cache.get_top(self._subreddit, self._top_num, self._api_calls, fetched_after)
+            self._api_calls.add()
+            start = time.perf_counter()
+            submissions = list(self._subreddit.top('day', limit=self._top_num))
+            REDDIT_REQUEST_SECONDS.observe(time.perf_counter() - start, listing='top')
+            return submissions
+
+    def _poll_listing(self) -> List[praw.models.Submission]:
+        # Arrivals are tracked as candidates and reposted once their score or score velocity crosses the threshold
+        with self._subreddit_lock, self._client_lock():
+            start = time.perf_counter()
+            if self._listing_mode == 'new':
+                # Only the posts newer than the newest seen one are returned
+                params = {'before': self._listing_cursor} if self._listing_cursor is not None else {}
+                arrivals = list(self._subreddit.new(limit=100, params=params))
             else:
-                if time.time() - last_post_time > self._browse_delay:
-                    post = True
-                else:
-                    time.sleep(1)
+                arrivals = list(self._subreddit.rising(limit=self._top_num))
+            REDDIT_REQUEST_SECONDS.observe(time.perf_counter() - start, listing=self._listing_mode)
+            self._api_calls.add()
+
+            if len(arrivals) > 0:
+                self._listing_cursor = arrivals[0].fullname
+                self._empty_polls = 0
+            else:
+                # The cursor post might have been deleted, which makes the listing empty forever
+                self._empty_polls += 1
+                if self._empty_polls >= 10:
+                    self._listing_cursor = None
+                    self._empty_polls = 0
+
+            now = time.time()
+            # Arrivals are listed with their current score, so they are checked without a refresh
+            refreshed = []
+            for submission in arrivals:
+                if submission.id not in self._seen:
+                    self._seen[submission.id] = submission.created_utc
+                    self._candidates[submission.id] = submission
+                    self._refreshed[submission.id] = now
+                    refreshed.append(submission)
+
+            expired = [x for x, created in self._seen.items() if now - created > SubredditBrowser.candidate_max_age]
+            for submission_id in expired:
+                del self._seen[submission_id]
+                self._candidates.pop(submission_id, None)
+                self._refreshed.pop(submission_id, None)
+
+            # Scores of older posts change slower, so they are refreshed less often. The longest unrefreshed
+            # candidates go first, with a single request per poll whatever the number of tracked candidates.
+            due = [x for x in self._candidates.values() if now - self._refreshed[x.id] >=
+                   max(self._poll_interval, (now - x.created_utc) * SubredditBrowser.candidate_refresh_ratio)]
+            due = sorted(due, key=lambda x: self._refreshed[x.id])[:SubredditBrowser.max_candidate_refresh]
+            if len(due) > 0:
+                start = time.perf_counter()
+                refreshed.extend(self._praw_core.info(fullnames=[x.fullname for x in due]))
+                REDDIT_REQUEST_SECONDS.observe(time.perf_counter() - start, listing='info')
+                self._api_calls.add()
+                for submission in due:
+                    self._refreshed[submission.id] = now
+
+        ready = []
+        for submission in refreshed:
+            age_hours = max(now - submission.created_utc, 60) / 3600
+            velocity = submission.score / age_hours
+            if submission.score >= self._min_score or (self._min_velocity > 0 and velocity >= self._min_velocity):
+                logging.debug(f"Post ID: {submission.id} crossed the threshold with score {submission.score}, "
+                              f"{velocity:.1f} per hour.")
+                ready.append((velocity, submission))
+                del self._candidates[submission.id]
+                del self._refreshed[submission.id]
+        return [x for _, x in sorted(ready, key=lambda x: x[0], reverse=True)]
+
+    def _flush_album(self, force: bool = False):
+        # Pending album items are sent when the album is full or the oldest item waited for album_flush_delay
+        if len(self._album_pending) == 0:
+            return
+        if not force and len(self._album_pending) < SubredditBrowser.album_max_size and \
+                time.time() - self._album_started < self._album_flush_delay:
+            return
+
+        logging.debug(f"Sending album of {len(self._album_pending)} items to {self._telegram_channel}.")
+        for (file_path, _, _), entry_id in zip(self._album_pending, self._album_entries):
+            self._track_sent(file_path, entry_id)
+        if len(self._album_pending) > 1:
+            sent = self._telegram_wrap.send_album_message(self._album_pending, chat_title=self._telegram_channel)
+        else:
+            # An album should contain at least 2 items
+            file_path, media_type, caption = self._album_pending[0]
+            sent = self._telegram_wrap.send_media_message(file_path,
+                                                          TelegramMediaType(media_type),
+                                                          chat_title=self._telegram_channel,
+                                                          caption=caption)
+        for file_path, _, _ in self._album_pending:
+            self._finish_send(file_path, sent)
+        self._album_pending = []
+        self._album_entries = []
+        self._album_started = None
+
+    def _evict_prefetches(self, prefetches: Iterable[Future]):
+        for preparation in prefetches:
+            if not preparation.cancel():
+                preparation.add_done_callback(self._remove_prepared_media)
+
+    def _filter_posted(self, submissions: List[praw.models.Submission]) -> List[praw.models.Submission]:
+        posted_key = f'{self._db_key_prefix}_posted_by_time'
+        if self._batched_dedup:
+            # Single round-trip for the whole browse window
+            with self._redis.pipeline(transaction=False) as pipe:
+                for submission in submissions:
+                    pipe.zscore(posted_key, submission.id)
+                post_times = pipe.execute()
+        else:
+            post_times = [self._redis.zscore(posted_key, x.id) for x in submissions]
+        return [x for x, post_time in zip(submissions, post_times) if post_time is None]
+
+    def _prepare_media(self, submission: praw.models.Submission) -> Tuple[Optional[str], List[int]]:
+        # Runs on the download pool, so the media is ready to be sent when its turn comes
+        stop_event = self._browse_stop
+        while not self._tmp_space.wait_for_space(timeout=1):
+            if stop_event is None or stop_event.is_set():
+                return None, []
+
+        file_path = self._extractor.extract_media(submission)
+        if file_path is not None and self._media_optimizer is not None:
+            optimized_path, original_size, optimized_size, elapsed = self._media_optimizer.optimize(file_path)
+            if optimized_path != file_path:
+                self._stat_collector.record_media_optimized(file_path, original_size, optimized_size, elapsed)
+                file_path = optimized_path
+        if file_path is not None:
+            self._tmp_space.track(file_path)
+        frame_hashes = []
+        if file_path is not None and self._phash_index is not None:
+            frame_hashes = PerceptualHash.frame_hashes(file_path)
+        return file_path, frame_hashes
+
+    def _prefetch(self):
+        # Media of the posts likely to be in the next window is prepared ahead, so the window starts posting at once
+        try:
+            submissions = self._fetch_top()
+        except (ServerError, RequestException):
+            logging.error("Reddit server error encountered. Nothing prefetched for the next browse window.")
+            return
+
+        queued = {x.id for x, _ in self._post_queue}
+        for submission in self._filter_posted(submissions):
+            if submission.id not in queued and submission.id not in self._prefetches:
+                self._prefetches[submission.id] = self._download_pool.submit(self._prepare_media, submission)
+        logging.debug(f"Prefetching {len(self._prefetches)} posts of the next browse window.")
+
+    def _queue_posts(self, posts: List[Tuple[praw.models.Submission, Future]]):
+        # Posts left from the previous window are spread across the next interval together with the new ones
+        self._post_queue.extend(posts)
+        self._pace_start = time.time()
+        self._pace_sent = 0
+        self._pace_total = len(self._post_queue)
+
+    def _claim_content(self, file_path: str) -> bool:
+        # Same media reposted under a new submission ID is posted to the channel only once
+        content_hash = self._media_cache.content_hash(file_path)
+        return self._redis.zadd(f'{self._db_key_prefix}_posted_hashes', {content_hash: time.time()}, nx=True) == 1
+
+    def _is_near_duplicate(self, frame_hashes: List[int]) -> bool:
+        match = self._phash_index.find(frame_hashes)
+        if match is not None:
+            logging.debug(f"Perceptual hash match {match[1]:016x} at distance {match[0]}.")
+            return True
+        self._phash_index.add(frame_hashes)
+        return False
+
+    def _claim_post(self, submission_id: str) -> bool:
+        # ZADD NX is atomic, only one of the workers sharing the DB gets True for a submission
+        return self._redis.zadd(f'{self._db_key_prefix}_posted_by_time', {submission_id: time.time()}, nx=True) == 1
+
+    def _migrate_post_storage(self):
+        # One-shot migration from the {prefix}_posted set and {prefix}_post_time hash to the sorted set
+        posted_key = f'{self._db_key_prefix}_posted'
+        post_time_key = f'{self._db_key_prefix}_post_time'
+        if not self._redis.exists(posted_key):
+            return
+
+        posted = self._redis.smembers(posted_key)
+        post_times = self._redis.hgetall(post_time_key)
+        now = time.time()
+        mapping = {sub_id: float(post_times.get(sub_id, now)) for sub_id in posted}
+        logging.info(f"Migrating {len(mapping)} posted entries to {self._db_key_prefix}_posted_by_time.")
+
+        with self._redis.pipeline(transaction=True) as pipe:
+            if len(mapping) > 0:
+                pipe.zadd(f'{self._db_key_prefix}_posted_by_time', mapping)
+            pipe.delete(posted_key, post_time_key)
+            pipe.execute()
 
     def _do_post_storage_cleanup(self):
-        to_del = []
-        for sub_id in self._redis.smembers(f'{self._db_key_prefix}_posted'):
-            posted_time = float(self._redis.hget(f'{self._db_key_prefix}_post_time', sub_id))
-            if time.time() - posted_time > self._cleanup_delay:
-                to_del.append(sub_id)
+        with self._redis.pipeline(transaction=False) as pipe:
+            for key in (f'{self._db_key_prefix}_posted_by_time', f'{self._db_key_prefix}_posted_hashes'):
+                pipe.zremrangebyscore(key, '-inf', time.time() - self._cleanup_delay)
+            pipe.execute()
+        if self._phash_index is not None:
+            self._phash_index.cleanup(time.time() - self._phash_ttl)
+
+    def _next_post_time(self) -> float:
+        # The schedule is computed from the current browse delay, so it follows browse delay changes
+        progress = self._pace_sent / self._pace_total
+        return self._pace_start + self._browse_delay * progress ** self._pacing_exponent
+
+    def _post_due(self):
+        while len(self._post_queue) > 0 and not self._browse_stop.is_set():
+            # Posts of the incremental modes are queued without a pacing schedule
+            if self._paced_posting and self._listing_mode == 'top' and time.time() < self._next_post_time():
+                break
+
+            # The preparation may wait for tmp space, which is released by this thread on the rejected posts
+            submission, preparation = self._post_queue[0]
+            if not preparation.done():
+                break
+            self._post_queue.popleft()
+            self._pace_sent += 1
+            file_path, frame_hashes = preparation.result()
+            if file_path is None:
+                continue
+            if not self._claim_post(submission.id):
+                logging.debug(f'Post ID: {submission.id} was already reposted by another worker.')
+                self._tmp_space.release(file_path)
+                continue
+            if self._media_cache is not None and not self._claim_content(file_path):
+                logging.debug(f'Media of post ID: {submission.id} was already posted to {self._telegram_channel}.')
+                self._tmp_space.release(file_path)
+                continue
+            if self._phash_index is not None and self._is_near_duplicate(frame_hashes):
+                logging.debug(f'Media of post ID: {submission.id} is similar to media already posted to '
+                              f'{self._telegram_channel}.')
+                self._tmp_space.release(file_path)
+                continue
 
-        for sub_id in to_del:
-            self._redis.srem(f'{self._db_key_prefix}_posted', sub_id)
-            self._redis.hdel(f'{self._db_key_prefix}_post_time', sub_id)
+            logging.debug(f'Reposting post ID: {submission.id} '
+                          f'from {submission.subreddit.display_name} '
+                          f'to {self._telegram_channel}.')
+            entry_id = None
+            if self._send_queue is not None:
+                entry_id = self._send_queue.add(file_path, submission.title, self._telegram_channel, submission.id)
+            self._post_media(file_path, submission.title, entry_id)
+            # self._telegram_wrap.send_text_message(submission.title,
+            #                                       chat_title=self._telegram_channel)
+
+    def _track_sent(self, file_path: str, entry_id: Optional[str]):
+        # Only the files sent by this browser are recorded as delivered, other browsers may share the Telegram client.
+        # Tracked before the send, the failure of a rejected request may be reported before the send call returns.
+        with self._sent_lock:
+            self._sent_files[os.path.realpath(file_path)] = entry_id
+        self._stat_collector.record_media_sent(file_path)
+
+    def _finish_send(self, file_path: str, sent: bool):
+        if not sent and self._release_unsent(file_path):
+            logging.warning(f"Failed to send {file_path} to {self._telegram_channel}.")
+
+    def _release_unsent(self, file_path: str) -> bool:
+        # The send queue entry is kept, the send is replayed once the grace period passes
+        with self._sent_lock:
+            if self._sent_files.pop(os.path.realpath(file_path), False) is False:
+                return False
+        self._tmp_space.release(file_path)
+        return True
+
+    def _replay_sends(self):
+        # Sends left unconfirmed by a stopped process or failed. The posts are already claimed, so they are not
+        # checked again. After a rebalance the previous owner of the route may still be sending the recent entries,
+        # so only the entries older than the grace period are replayed.
+        if self._send_queue is None:
+            return
+        with self._sent_lock:
+            in_flight = set(self._sent_files.values())
+        in_flight.update(self._album_entries)
+        in_flight.update(x for x, _, _ in self._replays)
+        entries = [x for x in self._send_queue.pending(SubredditBrowser.send_replay_grace) if x[0] not in in_flight]
+        if len(entries) > 0:
+            logging.info(f"Replaying {len(entries)} unconfirmed sends to {self._telegram_channel}.")
+
+        for entry_id, fields in entries:
+            attempts = int(fields['attempts']) + 1
+            if attempts > SubredditBrowser.max_send_replays:
+                logging.warning(f"Dropping send of post ID: {fields['post_id']} to {fields['chat']}, "
+                                f"not confirmed after {attempts - 1} replays.")
+                self._send_queue.complete(entry_id)
+                continue
+
+            if os.path.isfile(fields['path']):
+                self._tmp_space.track(fields['path'])
+                self._resend(entry_id, fields, fields['path'])
+            else:
+                # The file was swept or lost with the tmp directory, the media is prepared again. Like the posts, on
+                # the download pool, the preparation may wait for tmp space released by this thread.
+                self._replays.append((entry_id, fields, self._download_pool.submit(self._prepare_replay,
+                                                                                   fields['post_id'])))
+
+    def _prepare_replay(self, post_id: str) -> Tuple[Optional[str], List[int]]:
+        with self._client_lock():
+            start = time.perf_counter()
+            submissions = list(self._praw_core.info(fullnames=[f't3_{post_id}']))
+            REDDIT_REQUEST_SECONDS.observe(time.perf_counter() - start, listing='info')
+            self._api_calls.add()
+        if len(submissions) == 0:
+            return None, []
+        return self._prepare_media(submissions[0])
+
+    def _post_replays(self):
+        replays, self._replays = self._replays, []
+        for entry_id, fields, preparation in replays:
+            if not preparation.done():
+                self._replays.append((entry_id, fields, preparation))
+                continue
+            try:
+                file_path, _ = preparation.result()
+            except (ServerError, RequestException):
+                logging.error(f"Reddit server error encountered. Post ID: {fields['post_id']} not replayed.")
+                continue
+            if file_path is None:
+                logging.warning(f"Media of post ID: {fields['post_id']} is not available any more.")
+                self._send_queue.complete(entry_id)
+                continue
+            self._resend(entry_id, fields, file_path)
+
+    def _resend(self, entry_id: str, fields: Dict[str, str], file_path: str):
+        # The entry is replaced, so the number of replays survives another restart
+        new_entry_id = self._send_queue.add(file_path, fields['caption'], fields['chat'], fields['post_id'],
+                                            int(fields['attempts']) + 1)
+        self._send_queue.complete(entry_id)
+        self._post_media(file_path, fields['caption'], new_entry_id)
+
+    def _remove_prepared_media(self, preparation: Future):
+        if preparation.cancelled() or preparation.exception() is not None:
+            return
+        file_path, _ = preparation.result()
+        if file_path is not None:
+            logging.debug(f"Evicting unused prefetched file {file_path}.")
+            self._tmp_space.release(file_path)
+
+    def _post_media(self, file_path: str, caption: str, entry_id: Optional[str] = None):
+        media_type = TelegramHelper.determine_media_type(file_path)
+        if self._album_batching and isinstance(media_type.value, TelegramAlbumMediaType):
+            if len(self._album_pending) == 0:
+                self._album_started = time.time()
+            self._album_pending.append((file_path, media_type.value, caption))
+            self._album_entries.append(entry_id)
+            self._flush_album()
+        else:
+            self._track_sent(file_path, entry_id)
+            sent = self._telegram_wrap.send_media_message(file_path,
+                                                          media_type,
+                                                          chat_title=self._telegram_channel,
+                                                          caption=caption)
+            self._finish_send(file_path, sent)
 
     # Cannot be static, multiple browser objects may subscribe to same TelegramWrapper object
     def _process_message_sent(self, message: dict):
         logging.debug(f"Message sent notification received: {message}")
         path = TelegramHelper.extract_media_path(message)
-        if path is not None:
-            self._stat_collector.record_media_delivered(path)
-            os.remove(path)
+        if path is None:
+            return
+        with self._sent_lock:
+            if os.path.realpath(path) not in self._sent_files:
+                return
+            entry_id = self._sent_files.pop(os.path.realpath(path))
+
+        if entry_id is not None:
+            self._send_queue.complete(entry_id)
+        self._stat_collector.record_media_delivered(path)
+        self._tmp_space.release(path)
         logging.debug(f"Message processed: {message}. File removed: {path}")
 
+    # Cannot be static, multiple browser objects may subscribe to same TelegramWrapper object
+    def _process_message_failed(self, message: dict):
+        path = TelegramHelper.extract_media_path(message)
+        if path is not None and self._release_unsent(path):
+            logging.warning(f"Message failed: {message}. File removed: {path}")
+
+    # Cannot be static, multiple browser objects may subscribe to same TelegramWrapper object
+    def _process_request_failed(self, path: str):
+        if self._release_unsent(path):
+            logging.warning(f"Send request of {path} to {self._telegram_channel} failed. File removed.")
+
     def __del__(self):
         logging.debug(f"Deleting SubredditBrowser object.")
 
@@ -84,6 +493,8 @@ class SubredditBrowser:
         del self._praw_core
         del self._subreddit_lock
         del self._extractor
+        del self._download_pool
+        del self._listing_cache
 
         self._subreddit = None
         self._subreddit_lock = None
@@ -92,6 +503,13 @@ class SubredditBrowser:
         self._redis = None
         self._stat_collector = None
         self._extractor = None
+        self._download_pool = None
+        self._listing_cache = None
+        self._media_cache = None
+        self._phash_index = None
+        self._send_queue = None
+        self._media_optimizer = None
+        self._tmp_space = None
 
         logging.debug(f"SubredditBrowser object deleted.")
 
@@ -102,7 +520,7 @@ class SubredditBrowser:
         pass
 
     def __init__(self,
-                 reddit_creds: map,
+                 reddit_creds: Optional[map],
                  subreddit_name: str,
                  telegram_wrap: TelegramWrapper,
                  telegram_channel: str,
@@ -111,12 +529,33 @@ class SubredditBrowser:
                  top_num: int = 20,
                  browse_delay: int = 3600,  # one hour by default
                  cleanup_delay: int = 86400,  # one day by default
-                 tmp_dir: str = 'tmp'):
+                 tmp_dir: str = 'tmp',
+                 download_workers: int = 4,
+                 av_mux_mode: str = 'pipe',
+                 batched_dedup: bool = True,
+                 album_batching: bool = False,
+                 album_flush_delay: int = 60,
+                 paced_posting: bool = False,
+                 pacing_exponent: float = 1.0,
+                 praw_core: Optional[praw.Reddit] = None,
+                 listing_cache: Optional['ListingCache'] = None,
+                 media_cache: Optional[MediaCache] = None,
+                 phash_dedup: bool = False,
+                 phash_distance: int = 6,
+                 phash_ttl: int = 604800,  # one week by default
+                 listing_mode: str = 'top',
+                 poll_interval: int = 60,
+                 min_score: int = 100,
+                 min_velocity: float = 0.0,
+                 media_optimizer: Optional[MediaOptimizer] = None,
+                 prefetch_lead: int = 0,
+                 tmp_space: Optional[TmpSpaceManager] = None,
+                 durable_send: bool = True):
         """Initialize SubredditBrowser object.
 
         Args:
             reddit_creds: A map of reddit credentials. Should contain: client_id, client_secret, password, username,
-                user_agent. Visit https://reddit.com to obtain the credentials.
+                user_agent. Visit https://reddit.com to obtain the credentials. Ignored if praw_core is passed.
             subreddit_name: A subreddit to browse.
             telegram_wrap: Telegram client wrapper.
             redis_db: Redis DB instance. To store reposted posts IDs to avoid repost repetitions.
@@ -124,41 +563,130 @@ class SubredditBrowser:
             top_num: Number of posts to queue on each update.
             browse_delay: Delay in seconds after which the subreddit will be browsed for updates.
             cleanup_delay: Delay in seconds after which old entries from DB are removed.
-            tmp_dir: Path to a directory to store files temporarily. Warning: cleanup process removes all files from
-                the directory.
+            tmp_dir: Path to a directory to store files temporarily. The files are stored in a subdirectory named after
+                the subreddit and the channel. Warning: files older than a day, which are not waiting to be sent, are
+                removed from the directory. See TmpSpaceManager for details.
+            download_workers: Number of submissions which media is downloaded and prepared concurrently.
+            av_mux_mode: How reddit video and audio tracks are combined. 'pipe' or 'file'.
+                See SubmissionMediaExtractor for details.
+            batched_dedup: If True - already reposted posts are checked with a single Redis round-trip per browse
+                window.
+            album_batching: If True - images and videos are grouped into albums of up to 10 items.
+            album_flush_delay: Max delay in seconds an image or a video waits for an album to be filled.
+            paced_posting: If True - posts of a browse window are spread across the interval until the next browse
+                window instead of being sent at once.
+            pacing_exponent: Shape of the pacing curve. The k-th of n posts is sent (k / n) ** pacing_exponent of the
+                browse delay after the window start. 1 - evenly, less than 1 - more posts early in the window.
+            praw_core: Reddit client shared with other browsers. If None - a new client is created from reddit_creds.
+            listing_cache: ListingCache object shared with other browsers. If None - listings are always fetched.
+            media_cache: MediaCache object shared with other browsers. If set - cached media is reused instead of
+                being downloaded, and media already posted to the channel under another submission ID is skipped.
+            phash_dedup: If True - images and videos similar to media already posted to the channel are skipped.
+                Similarity is checked with perceptual hashes of the images and of the first video keyframes.
+            phash_distance: Max Hamming distance between 64-bit perceptual hashes of similar media.
+            phash_ttl: Time in seconds perceptual hashes of posted media are kept.
+            listing_mode: 'top' - top_num top posts of the day are queued every browse_delay seconds. 'new' or
+                'rising' - the listing is polled every poll_interval seconds, and posts are reposted as soon as they
+                reach min_score or min_velocity. The 'new' listing is followed with a cursor, so only new posts are
+                fetched. Paced posting applies to the 'top' mode only.
+            poll_interval: Delay in seconds between polls of the 'new' or 'rising' listing.
+            min_score: Score a post should reach to be reposted in the 'new' and 'rising' modes.
+            min_velocity: Score per hour since submission a post should reach to be reposted in the 'new' and 'rising'
+                modes. 0 - disabled.
+            media_optimizer: MediaOptimizer object shared with other browsers. If set - media is converted or
+                shrunk before sending, and the saved size and the time spent are recorded to stat_collector.
+            prefetch_lead: Time in seconds before the next browse window when the listing is fetched and the media
+                is prepared ahead. Prefetched posts which are not in the listing when the window starts are evicted.
+                0 - disabled. Applies to the 'top' mode only.
+            tmp_space: TmpSpaceManager object of tmp_dir shared with other browsers. If None - a manager without a
+                quota is created.
+            durable_send: If True - media sends are recorded in Redis until Telegram confirms the delivery. Sends left
+                unconfirmed by a stopped or crashed process, or failed, are replayed once they are older than
+                send_replay_grace, so a post may be delivered twice, but is never lost after being claimed as reposted.
         """
         logging.debug("Creating class SubredditBrowser object.")
-        self._praw_core = praw.Reddit(client_id=reddit_creds['client_id'],
-                                      client_secret=reddit_creds['client_secret'],
-                                      password=reddit_creds['password'],
-                                      username=reddit_creds['username'],
-                                      user_agent=reddit_creds['user_agent'])
+        if praw_core is not None:
+            self._praw_core = praw_core
+        else:
+            self._praw_core = praw.Reddit(client_id=reddit_creds['client_id'],
+                                          client_secret=reddit_creds['client_secret'],
+                                          password=reddit_creds['password'],
+                                          username=reddit_creds['username'],
+                                          user_agent=reddit_creds['user_agent'])
+            logging.info("Reddit login OK.")
         self._subreddit = self._praw_core.subreddit(subreddit_name)
         self._subreddit_lock = threading.Lock()
-        logging.info("Reddit login OK.")
+        self._listing_cache = listing_cache
 
         self._telegram_wrap = telegram_wrap
-        self._telegram_wrap.update_chat_ids()
+        self._telegram_wrap.update_chat_ids(timeout=10)
         self._telegram_channel = telegram_channel
 
         self._top_num = top_num
         self._browse_delay = browse_delay
+        self._api_calls = ApiCallCounter()
+
+        self._listing_mode = listing_mode
+        self._poll_interval = poll_interval
+        self._min_score = min_score
+        self._min_velocity = min_velocity
+        self._listing_cursor = None
+        self._empty_polls = 0
+        self._seen = {}
+        self._candidates = {}
+        self._refreshed = {}  # candidate post ID -> time of the last score refresh
+        self._prefetch_lead = prefetch_lead
+        self._prefetches = {}
 
         self._redis = redis_db
         self._cleanup_delay = cleanup_delay
         self._db_key_prefix = f"{subreddit_name}_{telegram_channel}"
+        self._batched_dedup = batched_dedup
 
-        self._stat_collector = stat_collector
+        self._album_batching = album_batching
+        self._album_flush_delay = album_flush_delay
+        self._album_pending = []
+        self._album_entries = []
+        self._album_started = None
 
-        self._browse_stop = threading.Event()
-        self._browse_worker = threading.Thread(target=self._browse_subreddit, args=())
-        self._browse_worker.start()
+        self._paced_posting = paced_posting
+        self._pacing_exponent = pacing_exponent
+        self._post_queue = deque()
+        self._pace_start = time.time()
+        self._pace_sent = 0
+        self._pace_total = 0
+
+        self._migrate_post_storage()
+
+        self._phash_index = PerceptualHashIndex(redis_db, self._db_key_prefix, phash_distance) if phash_dedup else None
+        self._phash_ttl = phash_ttl
+        self._send_queue = SendQueue(redis_db, self._db_key_prefix) if durable_send else None
+        self._replays = []  # (send queue entry ID, entry fields, preparation) of the replays with lost files
+
+        self._stat_collector = stat_collector
 
+        self._own_tmp_space = tmp_space is None
+        self._tmp_space = tmp_space if tmp_space is not None else TmpSpaceManager(tmp_dir)
+        # Routes of the same subreddit download the same submissions, so every route keeps its files apart
+        tmp_dir = os.path.join(tmp_dir, self._db_key_prefix)
         if not os.path.isdir(tmp_dir):
             os.makedirs(tmp_dir, exist_ok=True)
-        self._extractor = SubmissionMediaExtractor(tmp_dir)
+        self._sent_files = {}
+        self._sent_lock = threading.Lock()
+        self._media_cache = media_cache
+        self._media_optimizer = media_optimizer
+        self._extractor = SubmissionMediaExtractor(tmp_dir, av_mux_mode, media_cache)
+        self._download_pool = ThreadPoolExecutor(max_workers=max(1, download_workers),
+                                                 thread_name_prefix='MediaDownload')
 
         self._telegram_wrap.subscribe_message_sent(self._process_message_sent)
+        self._telegram_wrap.subscribe_message_failed(self._process_message_failed)
+        self._telegram_wrap.subscribe_request_failed(self._process_request_failed)
+
+        # Keep this section last. New thread may start using resources which are not initialized yet otherwise.
+        self._browse_stop = threading.Event()
+        self._browse_worker = threading.Thread(target=self._browse_subreddit, args=())
+        self._browse_worker.start()
 
     @property
     def browse_delay(self) -> int:
@@ -169,6 +697,10 @@ class SubredditBrowser:
         logging.info(f"Changing browse delay from {self.browse_delay} to {value}.")
         self._browse_delay = value
 
+    def api_calls_per_hour(self) -> int:
+        """Returns the number of Reddit API requests made in the last hour."""
+        return self._api_calls.per_hour()
+
     def is_running(self) -> bool:
         """Returns True is the subreddit browsing thread is running."""
         return not self._browse_stop.is_set()
@@ -176,12 +708,35 @@ class SubredditBrowser:
     def stop(self):
         """Stop subreddit browsing thread."""
         logging.debug(f"Stopping SubredditBrowser object.")
-        self._telegram_wrap.unsubscribe_message_sent(self._process_message_sent)
         if self._browse_stop is not None:
             self._browse_stop.set()
             self._browse_worker.join()
             self._browse_stop = None
             self._browse_worker = None
+            if self._send_queue is not None:
+                # Deliveries are not processed after the stop, the pending album is left to the replay instead
+                for file_path, _, _ in self._album_pending:
+                    self._tmp_space.release(file_path)
+                self._album_pending = []
+                self._album_entries = []
+                self._album_started = None
+            else:
+                self._flush_album(force=True)
+            self._evict_prefetches(preparation for _, preparation in self._post_queue)
+            self._post_queue.clear()
+            self._evict_prefetches(preparation for _, _, preparation in self._replays)
+            self._replays = []
+            self._evict_prefetches(self._prefetches.values())
+            self._prefetches = {}
+        self._telegram_wrap.unsubscribe_message_sent(self._process_message_sent)
+        self._telegram_wrap.unsubscribe_message_failed(self._process_message_failed)
+        self._telegram_wrap.unsubscribe_request_failed(self._process_request_failed)
+        if self._download_pool is not None:
+            self._download_pool.shutdown(wait=True)
+            self._download_pool = None
+        if self._own_tmp_space:
+            self._tmp_space.stop()
+            self._own_tmp_space = False
 
     @property
     def subreddit_name(self) -> str:
@@ -214,6 +769,85 @@ class SubredditBrowser:
         self._top_num = value
 
 
+class ApiCallCounter:
+    """Counts Reddit API requests made in the last hour."""
+
+    def _expire(self, now: float):
+        # Must be called with self._lock acquired
+        while len(self._calls) > 0 and now - self._calls[0][0] > 3600:
+            self._calls.popleft()
+
+    def __init__(self):
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def add(self, count: int = 1):
+        """Count API requests made now."""
+        now = time.time()
+        with self._lock:
+            self._calls.append((now, count))
+            self._expire(now)
+
+    def per_hour(self) -> int:
+        """Returns the number of API requests made in the last hour."""
+        with self._lock:
+            self._expire(time.time())
+            return sum(x for _, x in self._calls)
+
+
+class ListingCache:
+    """Shares subreddit listings between the routes browsing the same subreddit. It also serializes the requests made
+    through the shared Reddit client, which is not thread safe."""
+
+    def __init__(self, ttl: int = 300):
+        """Initialize ListingCache object.
+
+        Args:
+            ttl: Time in seconds a fetched listing is reused by other routes.
+        """
+        self._ttl = ttl
+        self._cache = {}
+        self._fetch_lock = threading.Lock()
+
+    @property
+    def client_lock(self) -> threading.Lock:
+        """Lock to hold while making requests through the shared Reddit client."""
+        return self._fetch_lock
+
+    def get_top(self,
+                subreddit: praw.models.Subreddit,
+                limit: int,
+                api_calls: Optional['ApiCallCounter'] = None,
+                fetched_after: float = 0) -> List[praw.models.Submission]:
+        """Get the top submissions of the day of a subreddit.
+
+        Args:
+            subreddit: Subreddit to fetch the listing of.
+            limit: Number of submissions to fetch.
+            api_calls: ApiCallCounter object to count the request in, if the listing is actually fetched.
+            fetched_after: Unix time a reused listing should be fetched after.
+        Returns:
+            List of submissions. A listing fetched less than ttl seconds ago, after fetched_after, with at least the
+            same limit is reused.
+        """
+        key = subreddit.display_name.lower()
+        with self._fetch_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                fetch_time, cached_limit, submissions = cached
+                if time.time() - fetch_time < self._ttl and fetch_time > fetched_after and cached_limit >= limit:
+                    logging.debug(f"Reusing cached listing of r/{key}.")
+                    return submissions[:limit]
+
+            if api_calls is not None:
+                api_calls.add()
+            start = time.perf_counter()
+            submissions = list(subreddit.top('day', limit=limit))
+            REDDIT_REQUEST_SECONDS.observe(time.perf_counter() - start, listing='top')
+            self._cache[key] = (time.time(), limit, submissions)
+            return submissions
+
+
 class SubmissionMediaExtractor:
     """This class encapsulates methods needed to extract media from reddit submissions"""
 
@@ -226,58 +860,159 @@ class SubmissionMediaExtractor:
             logging.debug(f"Extracting video and audio for submission id {submission.id}.")
 
             media_id = re.findall(r'^https://v\.redd\.it/(.+)', submission.url)[0]
-            default_ext = 'mp4'
+            video_url = submission.media['reddit_video']['fallback_url']
+            audio_url = f'https://v.redd.it/{media_id}/audio'
+            out_file = f'{self._down_dir}/{media_id}.mp4'
 
-            # Video part download
-            download_url = submission.media['reddit_video']['fallback_url']
-            file_path = f'{self._down_dir}/{media_id}_video'
-            video_file = DownloadManager.download_media(download_url, file_path, default_ext)
+            # The combined video is cached under the submission URL, it is not downloadable as a whole
+            if self._media_cache is not None:
+                cached_file = self._media_cache.get(submission.url, f'{self._down_dir}/{media_id}')
+                if cached_file is not None:
+                    return cached_file
 
-            if not os.path.isfile(video_file):
-                logging.debug(f"Problems downloading video file from submission id {submission.id}")
-                return None
+            if self._av_mux_mode == 'pipe':
+                out_file = self._mux_av_piped(video_url, audio_url, out_file)
             else:
-                logging.debug(f"Video part downloaded: {video_file}")
+                out_file = self._mux_av_files(video_url, audio_url, out_file)
 
-            download_url = f'https://v.redd.it/{media_id}/audio'
-            file_path = f'{self._down_dir}/{media_id}_audio'
-            audio_file = DownloadManager.download_media(download_url, file_path, default_ext)
+            if out_file is not None:
+                logging.debug(f"Combined video created: {out_file}")
+                if self._media_cache is not None:
+                    self._media_cache.put(submission.url, out_file)
+                return out_file
 
-            if not os.path.isfile(audio_file):
-                logging.debug(f"Problems downloading audio file from submission id {submission.id}")
-                if os.path.isfile(video_file):
-                    os.remove(video_file)
-                return None
-            else:
-                logging.debug(f"Audio part downloaded: {audio_file}")
+        logging.debug("Impossible to create combined video file.")
+        return None
 
-            out_file = f'{self._down_dir}/{media_id}.{default_ext}'
+    def _download(self, download_url: str, file_path: str, default_ext: str) -> Optional[str]:
+        if self._media_cache is not None:
+            cached_file = self._media_cache.get(download_url, file_path)
+            if cached_file is not None:
+                return cached_file
 
-            subprocess.run(['ffmpeg', '-loglevel', 'panic',
-                                      '-i', video_file,
-                                      '-i', audio_file,
-                                      '-c', 'copy',
-                                      out_file])
+        file_path = DownloadManager.download_media(download_url, file_path, default_ext)
+        if file_path is not None and self._media_cache is not None:
+            self._media_cache.put(download_url, file_path)
+        return file_path
 
-            if os.path.isfile(video_file):
-                os.remove(video_file)
+    def _mux_av_files(self, video_url: str, audio_url: str, out_file: str) -> Optional[str]:
+        # Both tracks are downloaded to disk concurrently and muxed afterwards
+        base_path = os.path.splitext(out_file)[0]
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='AVDownload') as pool:
+            video_download = pool.submit(DownloadManager.download_media, video_url, f'{base_path}_video', 'mp4')
+            audio_download = pool.submit(DownloadManager.download_media, audio_url, f'{base_path}_audio', 'mp4')
+            video_file = video_download.result()
+            audio_file = audio_download.result()
 
-            if os.path.isfile(audio_file):
-                os.remove(audio_file)
+        if video_file is None or audio_file is None:
+            logging.debug(f"Problems downloading video or audio part for {out_file}.")
+            for part_file in (video_file, audio_file):
+                if part_file is not None and os.path.isfile(part_file):
+                    os.remove(part_file)
+            return None
+        logging.debug(f"Video and audio parts downloaded: {video_file}, {audio_file}")
 
-            if os.path.isfile(out_file):
-                logging.debug(f"Combined video created: {out_file}")
-                return out_file
+        start = time.perf_counter()
+        subprocess.run(['ffmpeg', '-loglevel', 'panic', '-y',
+                                  '-i', video_file,
+                                  '-i', audio_file,
+                                  '-c', 'copy',
+                                  out_file])
+        FFMPEG_MUX_SECONDS.observe(time.perf_counter() - start, mode='file')
 
-        logging.debug("Impossible to create combined video file.")
+        if os.path.isfile(video_file):
+            os.remove(video_file)
+
+        if os.path.isfile(audio_file):
+            os.remove(audio_file)
+
+        return out_file if os.path.isfile(out_file) else None
+
+    def _mux_av_piped(self, video_url: str, audio_url: str, out_file: str) -> Optional[str]:
+        # Both tracks are streamed to ffmpeg through named pipes, so muxing starts with the first received chunks
+        # and the separate tracks never touch the disk.
+        fifo_dir = tempfile.mkdtemp(dir=self._down_dir)
+        video_fifo = f'{fifo_dir}/video'
+        audio_fifo = f'{fifo_dir}/audio'
+        try:
+            os.mkfifo(video_fifo)
+            os.mkfifo(audio_fifo)
+
+            # Includes streaming of both tracks, ffmpeg muxes them as they arrive
+            start = time.perf_counter()
+            ffmpeg = subprocess.Popen(['ffmpeg', '-loglevel', 'panic', '-y',
+                                       '-i', video_fifo,
+                                       '-i', audio_fifo,
+                                       '-c', 'copy',
+                                       out_file],
+                                      stdin=subprocess.DEVNULL)
+
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='AVStream') as pool:
+                video_stream = pool.submit(SubmissionMediaExtractor._stream_to_fifo, video_url, video_fifo, ffmpeg)
+                audio_stream = pool.submit(SubmissionMediaExtractor._stream_to_fifo, audio_url, audio_fifo, ffmpeg)
+                video_fetched = video_stream.result()
+                audio_fetched = audio_stream.result()
+            ffmpeg.wait()
+            FFMPEG_MUX_SECONDS.observe(time.perf_counter() - start, mode='pipe')
+        finally:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+        if ffmpeg.returncode == 0 and os.path.isfile(out_file):
+            return out_file
+
+        if os.path.isfile(out_file):
+            os.remove(out_file)
+
+        if video_fetched and audio_fetched:
+            # Both tracks are available, but ffmpeg failed to read them from a pipe, e.g. because of a
+            # non-seekable MP4 layout. Muxing from files is still possible.
+            logging.debug(f"Streaming mux failed for {out_file}. Falling back to muxing from files.")
+            return self._mux_av_files(video_url, audio_url, out_file)
         return None
 
-    def __init__(self, download_dir: str):
+    @staticmethod
+    def _open_fifo_writer(fifo_path: str, reader: subprocess.Popen) -> Optional[BinaryIO]:
+        # Opening a FIFO for writing blocks until the reader opens it. Poll instead, so a reader which exited
+        # without opening the FIFO does not block the writer forever.
+        while True:
+            try:
+                fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO or reader.poll() is not None:
+                    return None
+                time.sleep(0.01)
+            else:
+                os.set_blocking(fd, True)
+                return os.fdopen(fd, 'wb')
+
+    @staticmethod
+    def _stream_to_fifo(download_url: str, fifo_path: str, reader: subprocess.Popen) -> bool:
+        # Returns True if the remote file is available, even if the reader did not consume all of it
+        response = DownloadManager.open_stream(download_url)
+        fifo = SubmissionMediaExtractor._open_fifo_writer(fifo_path, reader)
+        if fifo is None:
+            if response is not None:
+                response.close()
+            return response is not None
+
+        # Closing the FIFO without writing anything makes the reader fail on this input
+        with fifo:
+            if response is not None:
+                DownloadManager.copy_stream(response, fifo)
+        return response is not None
+
+    def __init__(self, download_dir: str, av_mux_mode: str = 'pipe', media_cache: Optional[MediaCache] = None):
         """Initialize SubmissionMediaExtractor class
         Args:
             download_dir: Directory to which the files are downloaded.
+            av_mux_mode: How reddit video and audio tracks are combined. 'pipe' - tracks are streamed to ffmpeg
+                directly, 'file' - tracks are downloaded to disk and muxed afterwards.
+            media_cache: MediaCache object to reuse already downloaded media from. If None - media is always
+                downloaded.
         """
         self._down_dir = download_dir
+        self._av_mux_mode = av_mux_mode
+        self._media_cache = media_cache
 
     def extract_media(self, submission: praw.models.Submission) -> Optional[str]:
         download_url = None
@@ -330,6 +1065,5 @@ class SubmissionMediaExtractor:
                     file_path = f'{self._down_dir}/{media_id}'
                     default_ext = 'gif'
         if download_url is not None:
-            file_path = DownloadManager.download_media(download_url, file_path, default_ext)
-            return file_path
+            return self._download(download_url, file_path, default_ext)
         return None
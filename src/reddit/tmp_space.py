@@ -0,0 +1,187 @@
+"""This module contains a TmpSpaceManager object. This object keeps the directory of temporarily stored media within a
+disk quota and removes files left behind by failed sends and crashes."""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TmpSpaceManager:
+    """Tracks media files waiting to be sent. Downloads wait while the directory takes more space than the quota, and
+    files not tracked as in flight are swept once they are older than the orphan TTL: on start and periodically."""
+
+    usage_refresh_interval = 1.0  # sec, min delay between directory scans when the quota is checked
+
+    def _scan_usage(self) -> int:
+        usage = 0
+        for root, _, files in os.walk(self._tmp_dir):
+            for name in files:
+                try:
+                    usage += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return usage
+
+    def _sweep_worker(self):
+        logging.debug("Tmp space sweep thread started.")
+        while not self._stop_event.wait(self._sweep_interval):
+            self.sweep()
+
+    def __init__(self, tmp_dir: str, quota: int = 0, orphan_ttl: int = 86400, sweep_interval: int = 3600):
+        """Initialize TmpSpaceManager object. Orphans are swept before the constructor returns.
+
+        Args:
+            tmp_dir: Directory of the temporarily stored media.
+            quota: Max size of the directory in bytes, after which downloads wait for sent files to be removed.
+                0 - unlimited.
+            orphan_ttl: Time in seconds after which a file not tracked as in flight is removed.
+            sweep_interval: Delay in seconds between orphan sweeps.
+        """
+        self._tmp_dir = os.path.normpath(tmp_dir)
+        self._quota = quota
+        self._orphan_ttl = orphan_ttl
+        self._sweep_interval = sweep_interval
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._in_flight: Dict[str, float] = {}
+        self._usage = 0
+        self._usage_time = 0.0
+        self._waiting = 0
+        self._swept = 0
+        self.sweep()
+
+        self._stop_event = threading.Event()
+        self._sweep_thread = threading.Thread(target=self._sweep_worker, args=(), name='TmpSpaceSweep')
+        self._sweep_thread.start()
+
+    def release(self, file_path: str) -> bool:
+        """Remove a file and stop tracking it.
+
+        Args:
+            file_path: Path to the file.
+        Returns:
+            bool: True if the file was tracked as in flight.
+        """
+        with self._cond:
+            tracked = self._in_flight.pop(os.path.realpath(file_path), None) is not None
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        with self._cond:
+            self._usage_time = 0.0
+            self._cond.notify_all()
+        return tracked
+
+    def stats(self) -> Dict[str, int]:
+        """Get tmp space statistics.
+
+        Returns:
+            A dictionary containing next keys:
+                'usage'     - size of the directory in bytes at the last scan.
+                'quota'     - max size of the directory in bytes, 0 - unlimited.
+                'in_flight' - number of files waiting to be sent or delivered.
+                'waiting'   - number of downloads waiting for free space.
+                'swept'     - total number of removed orphans.
+        """
+        with self._cond:
+            return {'usage': self._usage,
+                    'quota': self._quota,
+                    'in_flight': len(self._in_flight),
+                    'waiting': self._waiting,
+                    'swept': self._swept}
+
+    def stop(self):
+        """Stop the sweep thread."""
+        logging.debug(f"Stopping TmpSpaceManager object.")
+        self._stop_event.set()
+        self._sweep_thread.join()
+        with self._cond:
+            self._cond.notify_all()
+
+    def sweep(self):
+        """Remove files older than the orphan TTL which are not tracked as in flight, anywhere under the directory.
+        Emptied subdirectories older than the TTL are removed too, except the top level ones used by the browsers."""
+        now = time.time()
+        with self._cond:
+            in_flight = set(self._in_flight)
+        for root, dirs, files in os.walk(self._tmp_dir, topdown=False):
+            try:
+                # Removing the files below updates the modification time
+                root_age = now - os.lstat(root).st_mtime
+            except FileNotFoundError:
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.realpath(path) in in_flight or now - os.lstat(path).st_mtime < self._orphan_ttl:
+                        continue
+                    logging.info(f"Removing orphaned tmp file {path}.")
+                    os.remove(path)
+                    with self._cond:
+                        self._swept += 1
+                except FileNotFoundError:
+                    pass
+
+            if os.path.dirname(root) == self._tmp_dir or root == self._tmp_dir:
+                continue
+            try:
+                # Left by interrupted muxing, e.g. a directory of named pipes
+                if root_age >= self._orphan_ttl and len(os.listdir(root)) == 0:
+                    os.rmdir(root)
+            except OSError:
+                pass
+
+        with self._cond:
+            self._usage_time = 0.0
+            self._cond.notify_all()
+
+    def track(self, file_path: str):
+        """Start tracking a file as in flight. The file is not swept until released.
+
+        Args:
+            file_path: Path to the file.
+        """
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError:
+            file_size = 0
+        with self._cond:
+            self._in_flight[os.path.realpath(file_path)] = time.time()
+            # Keeps the usage up to date between the scans
+            self._usage += file_size
+
+    def wait_for_space(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the directory takes less space than the quota. The quota is soft: downloads already started are
+        not limited, so it may be exceeded by up to the number of concurrent downloads times the media size.
+
+        Args:
+            timeout: Max time in seconds to wait. If None - wait until there is free space or the manager is stopped.
+        Returns:
+            bool: True if there is free space. False on timeout.
+        """
+        if self._quota <= 0:
+            return True
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            self._waiting += 1
+            try:
+                while not self._stop_event.is_set():
+                    now = time.monotonic()
+                    if now - self._usage_time > TmpSpaceManager.usage_refresh_interval:
+                        self._usage = self._scan_usage()
+                        self._usage_time = now
+                    if self._usage < self._quota:
+                        return True
+
+                    remaining = deadline - now if deadline is not None else TmpSpaceManager.usage_refresh_interval
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(min(remaining, TmpSpaceManager.usage_refresh_interval))
+                return True
+            finally:
+                self._waiting -= 1
@@ -1,15 +1,21 @@
 """This is an entry file for Flask ReddigramReposter app"""
-from flask import Flask, redirect, render_template, request, url_for, abort
+from flask import Flask, redirect, render_template, request, url_for, abort, make_response
+import hashlib
 import json
 import logging
+from metrics import format_metric, InstrumentedRedis, REGISTRY
 import os
-from reddit.subreddit_browser import SubredditBrowser
-from redis import Redis
+from reddit.coordinator import WorkerCoordinator
+from reddit.media_cache import MediaCache
+from reddit.media_optimizer import MediaOptimizer
+from reddit.router import SubredditRouter
+from reddit.tmp_space import TmpSpaceManager
 import secrets
 import settings as app_settings
-from stats import StatCollector, DataExtractor, BY_TYPE_KEYS, BY_TYPE_SIZE_KEYS
+from stats import StatCollector, StatsCache, DataExtractor, BY_TYPE_KEYS, BY_TYPE_SIZE_KEYS
 from telegram.telegram_wrapper import TelegramWrapper, TelegramAuthState
 import time
+from typing import Tuple
 
 app_root = os.path.dirname(__file__)
 app = Flask("ReddigramReposter", root_path=app_root, static_folder=f'{app_root}/static')
@@ -21,7 +27,8 @@ logging.basicConfig(filename=app_settings.log_location,
 
 # redis init
 logging.debug(f"Connecting to Redis instance at {secrets.redis_host}:{secrets.redis_port}")
-redis = Redis(host=secrets.redis_host, port=secrets.redis_port, db=secrets.redis_db)
+# round-trip times of the commands are exposed at /metrics
+redis = InstrumentedRedis(host=secrets.redis_host, port=secrets.redis_port, db=secrets.redis_db)
 assert redis.ping()
 logging.info(f"Connected to Redis instance at {secrets.redis_host}:{secrets.redis_port}")
 
@@ -30,102 +37,148 @@ telegram = None
 stat_collector = None
 reddit = None
 
+# dashboard stats are cached for a short time and invalidated when new stats are recorded
+dashboard_cache = StatsCache(app_settings.dash_cache_ttl)
 
-@app.route('/')
-def index():
-    global telegram
-    global stat_collector
 
-    today_stats_dict = None
-    totals_stats_dict = None
-    week_stats_dict = None
+def build_dashboard_stats(collector: StatCollector) -> Tuple[dict, dict, dict]:
+    """Compute today, week and totals dashboard chart data.
 
-    if stat_collector is not None:
+    Args:
+        collector: StatCollector object to fetch the statistics from.
+    Returns:
+        A tuple of today, week and totals stats dicts passed to the index template.
+    """
+    all_stats = collector.get_all_stats()
+
+    # Today statistics extraction
+    today_sent = all_stats['today_sent']
+    today_sent_list = [['Type', f'Number sent']] + DataExtractor.extract_media_by_type(today_sent)
+
+    today_delivered = all_stats['today_delivered']
+    today_delivered_list = [['Type', f'Number delivered']] + \
+        DataExtractor.extract_media_by_type(today_delivered)
+
+    today_sent_size_list = [['Type', 'Size of sent']] + DataExtractor.extract_media_by_type_size(today_sent)
+
+    today_delivered_size_list = [['Type', 'Size of delivered']] + \
+        DataExtractor.extract_media_by_type_size(today_delivered)
+
+    today_sent_delivered = [['Type', 'Number'],
+                            ['Sent', today_sent['total']],
+                            ['Delivered', today_delivered['total']]]
 
-        # Today statistics extraction
-        today_sent = stat_collector.get_today_sent()
-        today_sent_list = [['Type', f'Number sent']] + DataExtractor.extract_media_by_type(today_sent)
+    today_sent_delivered_size = [['Type', 'Number'],
+                                 ['Sent', today_sent['total_size']],
+                                 ['Delivered', today_delivered['total_size']]]
 
-        today_delivered = stat_collector.get_today_delivered()
-        today_delivered_list = [['Type', f'Number delivered']] + \
-            DataExtractor.extract_media_by_type(today_delivered)
+    today_stats_dict = {'today_by_type_sent': json.dumps(today_sent_list),
+                        'today_by_type_delivered': json.dumps(today_delivered_list),
+                        'today_by_type_size_sent': json.dumps(today_sent_size_list),
+                        'today_by_type_size_delivered': json.dumps(today_delivered_size_list),
+                        'today_sent_delivered': json.dumps(today_sent_delivered),
+                        'today_sent_delivered_size': json.dumps(today_sent_delivered_size)}
 
-        today_sent_size_list = [['Type', 'Size of sent']] + DataExtractor.extract_media_by_type_size(today_sent)
+    # Week stats extraction
+    week_sent = all_stats['week_sent']
+    week_delivered = all_stats['week_delivered']
 
-        today_delivered_size_list = [['Type', 'Size of delivered']] + \
-            DataExtractor.extract_media_by_type_size(today_delivered)
+    week_sent_list = [['Day'] + [BY_TYPE_KEYS[key] for key in BY_TYPE_KEYS]]
+    week_sent_list += DataExtractor.extract_multiday_media_by_type(week_sent)
 
-        today_sent_delivered = [['Type', 'Number'],
-                                ['Sent', today_sent['total']],
-                                ['Delivered', today_delivered['total']]]
+    week_sent_size_list = [['Day'] + [BY_TYPE_SIZE_KEYS[key] for key in BY_TYPE_SIZE_KEYS]]
+    week_sent_size_list += DataExtractor.extract_multiday_media_by_type_size(week_sent)
 
-        today_sent_delivered_size = [['Type', 'Number'],
-                                     ['Sent', today_sent['total_size']],
-                                     ['Delivered', today_delivered['total_size']]]
+    week_delivered_list = [['Day'] + [BY_TYPE_KEYS[key] for key in BY_TYPE_KEYS]]
+    week_delivered_list += DataExtractor.extract_multiday_media_by_type(week_delivered)
 
-        today_stats_dict = {'today_by_type_sent': json.dumps(today_sent_list),
-                            'today_by_type_delivered': json.dumps(today_delivered_list),
-                            'today_by_type_size_sent': json.dumps(today_sent_size_list),
-                            'today_by_type_size_delivered': json.dumps(today_delivered_size_list),
-                            'today_sent_delivered': json.dumps(today_sent_delivered),
-                            'today_sent_delivered_size': json.dumps(today_sent_delivered_size)}
+    week_delivered_size_list = [['Day'] + [BY_TYPE_SIZE_KEYS[key] for key in BY_TYPE_SIZE_KEYS]]
+    week_delivered_size_list += DataExtractor.extract_multiday_media_by_type_size(week_delivered)
 
-        # Week stats extraction
-        week_sent = stat_collector.get_week_sent()
-        week_delivered = stat_collector.get_week_delivered()
+    week_stats_dict = {'week_sent': json.dumps(week_sent_list),
+                       'week_sent_size': json.dumps(week_sent_size_list),
+                       'week_delivered': json.dumps(week_delivered_list),
+                       'week_delivered_size': json.dumps(week_delivered_size_list)}
 
-        week_sent_list = [['Day'] + [BY_TYPE_KEYS[key] for key in BY_TYPE_KEYS]]
-        week_sent_list += DataExtractor.extract_multiday_media_by_type(week_sent)
+    # Totals statistics extraction
+    totals_sent = all_stats['totals_sent']
+    totals_sent_list = [['Type', f'Number sent']] + DataExtractor.extract_media_by_type(totals_sent)
 
-        week_sent_size_list = [['Day'] + [BY_TYPE_SIZE_KEYS[key] for key in BY_TYPE_SIZE_KEYS]]
-        week_sent_size_list += DataExtractor.extract_multiday_media_by_type_size(week_sent)
+    totals_delivered = all_stats['totals_delivered']
+    totals_delivered_list = [['Type', f'Number delivered']] + \
+        DataExtractor.extract_media_by_type(totals_delivered)
 
-        week_delivered_list = [['Day'] + [BY_TYPE_KEYS[key] for key in BY_TYPE_KEYS]]
-        week_delivered_list += DataExtractor.extract_multiday_media_by_type(week_delivered)
+    totals_sent_size_list = [['Type', 'Size of sent']] + DataExtractor.extract_media_by_type_size(totals_sent)
 
-        week_delivered_size_list = [['Day'] + [BY_TYPE_SIZE_KEYS[key] for key in BY_TYPE_SIZE_KEYS]]
-        week_delivered_size_list += DataExtractor.extract_multiday_media_by_type_size(week_delivered)
+    totals_delivered_size_list = [['Type', 'Size of delivered']] + \
+        DataExtractor.extract_media_by_type_size(totals_delivered)
 
-        week_stats_dict = {'week_sent': json.dumps(week_sent_list),
-                           'week_sent_size': json.dumps(week_sent_size_list),
-                           'week_delivered': json.dumps(week_delivered_list),
-                           'week_delivered_size': json.dumps(week_delivered_size_list)}
+    totals_sent_delivered = [['Type', 'Number'],
+                             ['Sent', totals_sent['total']],
+                             ['Delivered', totals_delivered['total']]]
 
-        # Totals statistics extraction
-        totals_sent = stat_collector.get_totals_sent()
-        totals_sent_list = [['Type', f'Number sent']] + DataExtractor.extract_media_by_type(totals_sent)
+    totals_sent_delivered_size = [['Type', 'Number'],
+                                  ['Sent', totals_sent['total_size']],
+                                  ['Delivered', totals_delivered['total_size']]]
 
-        totals_delivered = stat_collector.get_totals_delivered()
-        totals_delivered_list = [['Type', f'Number delivered']] + \
-            DataExtractor.extract_media_by_type(totals_delivered)
+    totals_stats_dict = {'totals_by_type_sent': json.dumps(totals_sent_list),
+                         'totals_by_type_delivered': json.dumps(totals_delivered_list),
+                         'totals_by_type_size_sent': json.dumps(totals_sent_size_list),
+                         'totals_by_type_size_delivered': json.dumps(totals_delivered_size_list),
+                         'totals_sent_delivered': json.dumps(totals_sent_delivered),
+                         'totals_sent_delivered_size': json.dumps(totals_sent_delivered_size)}
 
-        totals_sent_size_list = [['Type', 'Size of sent']] + DataExtractor.extract_media_by_type_size(totals_sent)
+    return today_stats_dict, week_stats_dict, totals_stats_dict
 
-        totals_delivered_size_list = [['Type', 'Size of delivered']] + \
-            DataExtractor.extract_media_by_type_size(totals_delivered)
 
-        totals_sent_delivered = [['Type', 'Number'],
-                                 ['Sent', totals_sent['total']],
-                                 ['Delivered', totals_delivered['total']]]
+def create_stat_collector(db_prefix: str) -> StatCollector:
+    """Get a StatCollector object for a route. The dashboard collector is reused for the primary route.
 
-        totals_sent_delivered_size = [['Type', 'Number'],
-                                      ['Sent', totals_sent['total_size']],
-                                      ['Delivered', totals_delivered['total_size']]]
+    Args:
+        db_prefix: DB key prefix of the route.
+    Returns:
+        StatCollector: Statistics of the route.
+    """
+    if stat_collector is not None and stat_collector.db_prefix == db_prefix:
+        return stat_collector
 
-        totals_stats_dict = {'totals_by_type_sent': json.dumps(totals_sent_list),
-                             'totals_by_type_delivered': json.dumps(totals_delivered_list),
-                             'totals_by_type_size_sent': json.dumps(totals_sent_size_list),
-                             'totals_by_type_size_delivered': json.dumps(totals_delivered_size_list),
-                             'totals_sent_delivered': json.dumps(totals_sent_delivered),
-                             'totals_sent_delivered_size': json.dumps(totals_sent_delivered_size)}
+    return StatCollector(redis,
+                         db_prefix,
+                         flush_every=app_settings.stats_flush_every,
+                         flush_interval=app_settings.stats_flush_interval)
 
-    return render_template('index.html',
-                           logged_in=telegram is not None,
-                           subreddit=app_settings.red_subreddit_name,
-                           tel_channel=app_settings.tel_channel_name,
-                           today_stats_dict=today_stats_dict,
-                           week_stats_dict=week_stats_dict,
-                           totals_stats_dict=totals_stats_dict)
+
+@app.route('/')
+def index():
+    global telegram
+    global stat_collector
+
+    today_stats_dict = None
+    totals_stats_dict = None
+    week_stats_dict = None
+    stats_etag = ''
+
+    if stat_collector is not None:
+        (today_stats_dict, week_stats_dict, totals_stats_dict), stats_etag = \
+            dashboard_cache.get(stat_collector, build_dashboard_stats)
+
+    logged_in = telegram is not None
+    etag = hashlib.sha1(f"{stats_etag}|{logged_in}|{app_settings.red_subreddit_name}|"
+                        f"{app_settings.tel_channel_name}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    response = make_response(render_template('index.html',
+                                              logged_in=logged_in,
+                                              subreddit=app_settings.red_subreddit_name,
+                                              tel_channel=app_settings.tel_channel_name,
+                                              today_stats_dict=today_stats_dict,
+                                              week_stats_dict=week_stats_dict,
+                                              totals_stats_dict=totals_stats_dict))
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -143,7 +196,16 @@ def login():
 
     if telegram is None:
         telegram = TelegramWrapper(tdlib_log_file=app_settings.tel_log_file,
-                                   tdlib_log_verbosity=app_settings.tel_log_verbosity)
+                                   tdlib_log_verbosity=app_settings.tel_log_verbosity,
+                                   receive_timeout_min=app_settings.tel_receive_timeout_min,
+                                   receive_timeout_max=app_settings.tel_receive_timeout_max,
+                                   callback_workers=app_settings.tel_callback_workers,
+                                   callback_queue_size=app_settings.tel_callback_queue_size,
+                                   max_in_flight=app_settings.tel_max_in_flight,
+                                   json_backend=app_settings.tel_json_backend,
+                                   send_rate=app_settings.tel_send_rate,
+                                   send_burst=app_settings.tel_send_burst,
+                                   send_max_retries=app_settings.tel_send_max_retries)
 
     while telegram.authentication_state != TelegramAuthState.READY:
 
@@ -162,24 +224,63 @@ def login():
         time.sleep(0.5)
 
     if stat_collector is None:
-        stat_collector = StatCollector(redis, f"{app_settings.red_subreddit_name}_{app_settings.tel_channel_name}")
+        dashboard_cache.invalidate()
+        stat_collector = create_stat_collector(f"{app_settings.red_subreddit_name}_{app_settings.tel_channel_name}")
 
     if reddit is None:
-        telegram.update_chat_ids()
-        time.sleep(1)
-        reddit = SubredditBrowser(reddit_creds={'client_id': secrets.red_client_id,
-                                                'client_secret': secrets.red_client_secret,
-                                                'username': secrets.red_username,
-                                                'password': secrets.red_password,
-                                                'user_agent': secrets.red_user_agent},
-                                  subreddit_name=app_settings.red_subreddit_name,
-                                  telegram_wrap=telegram,
-                                  telegram_channel=app_settings.tel_channel_name,
-                                  redis_db=redis,
-                                  stat_collector=stat_collector,
-                                  top_num=app_settings.red_top_entries_num,
-                                  browse_delay=app_settings.red_browse_delay,
-                                  tmp_dir=app_settings.red_tmp_dir)
+        telegram.update_chat_ids(timeout=app_settings.tel_request_timeout)
+        routes = [(app_settings.red_subreddit_name, app_settings.tel_channel_name)] + app_settings.red_extra_routes
+        coordinator = None
+        if app_settings.red_distributed:
+            coordinator = WorkerCoordinator(redis,
+                                            worker_id=app_settings.red_worker_id,
+                                            lease_ttl=app_settings.red_worker_lease)
+        media_cache = None
+        if app_settings.red_media_cache_size > 0:
+            media_cache = MediaCache(app_settings.red_media_cache_dir, app_settings.red_media_cache_size * 1024 * 1024)
+        media_optimizer = None
+        if app_settings.red_optimize_media:
+            media_optimizer = MediaOptimizer(workers=app_settings.red_optimize_workers,
+                                             max_image_side=app_settings.red_max_image_side,
+                                             max_image_size=app_settings.red_max_image_size * 1024 * 1024,
+                                             max_video_size=app_settings.red_max_video_size * 1024 * 1024)
+        tmp_space = TmpSpaceManager(app_settings.red_tmp_dir,
+                                    quota=app_settings.red_tmp_quota * 1024 * 1024,
+                                    orphan_ttl=app_settings.red_tmp_orphan_ttl,
+                                    sweep_interval=app_settings.red_tmp_sweep_interval)
+        reddit = SubredditRouter(reddit_creds={'client_id': secrets.red_client_id,
+                                               'client_secret': secrets.red_client_secret,
+                                               'username': secrets.red_username,
+                                               'password': secrets.red_password,
+                                               'user_agent': secrets.red_user_agent},
+                                 routes=routes,
+                                 telegram_wrap=telegram,
+                                 redis_db=redis,
+                                 stat_collector_factory=create_stat_collector,
+                                 listing_ttl=app_settings.red_listing_ttl,
+                                 coordinator=coordinator,
+                                 top_num=app_settings.red_top_entries_num,
+                                 browse_delay=app_settings.red_browse_delay,
+                                 tmp_dir=app_settings.red_tmp_dir,
+                                 download_workers=app_settings.red_download_workers,
+                                 av_mux_mode=app_settings.red_av_mux_mode,
+                                 batched_dedup=app_settings.red_batched_dedup,
+                                 album_batching=app_settings.red_album_batching,
+                                 album_flush_delay=app_settings.red_album_flush_delay,
+                                 paced_posting=app_settings.red_paced_posting,
+                                 pacing_exponent=app_settings.red_pacing_exponent,
+                                 media_cache=media_cache,
+                                 phash_dedup=app_settings.red_phash_dedup,
+                                 phash_distance=app_settings.red_phash_distance,
+                                 phash_ttl=app_settings.red_phash_ttl,
+                                 listing_mode=app_settings.red_listing_mode,
+                                 poll_interval=app_settings.red_poll_interval,
+                                 min_score=app_settings.red_min_score,
+                                 min_velocity=app_settings.red_min_velocity,
+                                 media_optimizer=media_optimizer,
+                                 prefetch_lead=app_settings.red_prefetch_lead,
+                                 tmp_space=tmp_space,
+                                 durable_send=app_settings.red_durable_send)
 
     return redirect(url_for('index'))
 
@@ -193,12 +294,14 @@ def logout():
 
     reddit.stop()
     telegram.stop()
+    stat_collector.stop()
 
     del reddit
     reddit = None
 
     del stat_collector
     stat_collector = None
+    dashboard_cache.invalidate()
 
     del telegram
     telegram = None
@@ -215,6 +318,37 @@ def mfa_code():
         return render_template('mfa.html')
 
 
+@app.route('/metrics')
+def metrics():
+    body = REGISTRY.render()
+
+    if telegram is not None:
+        event_stats = telegram.get_event_stats()
+        _, receive_wait, _ = event_stats.pop('receive_wait')
+        event_types = sorted(event_stats.items())
+        body += format_metric('reposter_tdlib_events_total', 'counter', 'TDLib updates received.',
+                              [({'type': k}, v[0]) for k, v in event_types])
+        body += format_metric('reposter_tdlib_events_skipped_total', 'counter',
+                              'TDLib updates skipped without parsing.',
+                              [({'type': k}, v[2]) for k, v in event_types])
+        body += format_metric('reposter_tdlib_event_handle_seconds_total', 'counter',
+                              'Time the receiver thread spent parsing and handling TDLib updates.',
+                              [({'type': k}, v[1]) for k, v in event_types])
+        body += format_metric('reposter_tdlib_receive_wait_seconds_total', 'counter',
+                              'Time the receiver thread waited for TDLib updates.', [({}, receive_wait)])
+        body += format_metric('reposter_tdlib_requests_in_flight', 'gauge', 'TDLib requests waiting for a response.',
+                              [({}, telegram.get_request_stats()['in_flight'])])
+        body += format_metric('reposter_tdlib_send_queue_depth', 'gauge',
+                              'Messages waiting to be sent because of the rate limits.',
+                              [({}, telegram.get_send_queue_depth())])
+
+    if reddit is not None:
+        body += format_metric('reposter_reddit_api_calls_per_hour', 'gauge',
+                              'Reddit API requests made in the last hour.', [({}, reddit.api_calls_per_hour())])
+
+    return make_response(body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     global reddit
@@ -5,12 +5,58 @@ tel_channel_name = ''
 tel_db_dir = None
 tel_log_file = None
 tel_log_verbosity = 2  # WARNING level
+tel_receive_timeout_min = 1.0  # sec, TDLib receive timeout while updates are coming in
+tel_receive_timeout_max = 5.0  # sec, TDLib receive timeout when idle
+tel_callback_workers = 2  # threads running message sent callbacks, 0 - run them on the TDLib receiver thread
+tel_callback_queue_size = 1000
+tel_max_in_flight = 100  # TDLib requests waiting for a response
+tel_request_timeout = 10  # sec, time to wait for TDLib to confirm a request
+tel_json_backend = None  # 'orjson' or 'json', None - orjson if installed
+tel_send_rate = 0.3  # max messages per second to a single chat, 0 - no rate limiting and no flood wait retries
+tel_send_burst = 5  # max messages sent to a single chat at once
+tel_send_max_retries = 5  # retries of a message rejected by flood limits
 
 # Reddit settings
 red_subreddit_name = ''
 red_top_entries_num = 20
 red_browse_delay = 3600  # sec
 red_tmp_dir = 'data/tmp'
+red_download_workers = 4  # submissions downloaded concurrently
+red_av_mux_mode = 'pipe'  # 'pipe' - stream reddit video and audio to ffmpeg, 'file' - mux downloaded files
+red_batched_dedup = True  # check reposted posts with one Redis round-trip per browse window
+red_album_batching = False  # group images and videos into albums of up to 10 items
+red_album_flush_delay = 60  # sec, max time an item waits for an album to be filled
+red_paced_posting = False  # spread posts of a browse window across the browse delay
+red_pacing_exponent = 1.0  # pacing curve, 1 - evenly, less than 1 - more posts early in the window
+red_extra_routes = []  # additional (subreddit, telegram channel) pairs served by the same process
+red_listing_ttl = 300  # sec, time a subreddit listing is shared by routes browsing the same subreddit
+red_distributed = False  # split the routes between the reposter workers sharing the Redis DB
+red_worker_id = None  # unique name of this worker, None - host name and process ID
+red_worker_lease = 30  # sec, a worker not renewing its lease for this time is replaced by the others
+red_media_cache_dir = 'data/media_cache'  # should be on the same file system as red_tmp_dir
+red_media_cache_size = 1024  # MB, downloaded media kept for reuse, 0 - disabled
+red_phash_dedup = False  # skip images and videos similar to already posted ones, requires ffmpeg
+red_phash_distance = 6  # max number of differing bits of 64-bit perceptual hashes of similar media
+red_phash_ttl = 604800  # sec, time perceptual hashes of posted media are kept
+red_listing_mode = 'top'  # 'top' - top of the day every browse delay, 'new' or 'rising' - poll and repost on threshold
+red_poll_interval = 60  # sec, 'new' and 'rising' modes listing poll interval
+red_min_score = 100  # 'new' and 'rising' modes, score a post should reach to be reposted
+red_min_velocity = 0.0  # 'new' and 'rising' modes, score per hour a post should reach to be reposted, 0 - disabled
+red_optimize_media = False  # convert GIFs to MP4, downscale large images and re-encode large videos before sending
+red_optimize_workers = 2  # media files optimized concurrently
+red_max_image_side = 2560  # px
+red_max_image_size = 5  # MB
+red_max_video_size = 20  # MB
+red_prefetch_lead = 0  # sec, prepare media of the next browse window this time ahead, 0 - disabled
+red_tmp_quota = 0  # MB, downloads wait while red_tmp_dir takes more space, 0 - unlimited
+red_tmp_orphan_ttl = 86400  # sec, files in red_tmp_dir not waiting to be sent are removed after this time
+red_tmp_sweep_interval = 3600  # sec
+red_durable_send = True  # keep sends in Redis until delivered and replay them after a restart, may deliver twice
+
+# Statistics
+stats_flush_every = 0  # buffer stat counters and write them every N events, 0 - write immediately
+stats_flush_interval = 10  # sec, max delay of buffered stat counters
+dash_cache_ttl = 10  # sec, dashboard stats cache lifetime
 
 # General
 log_location = None
@@ -1,11 +1,15 @@
 """This module contains all the objects required to collect statistics on reposted posts."""
 import datetime
+import hashlib
+import json
 import logging
 import os
 from redis import Redis
 from telegram.utils import TelegramHelper
 from telegram.telegram_wrapper import TelegramMediaType
-from typing import Dict, List, Tuple, TypeVar
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
 
 
 BY_TYPE_KEYS = {'total_image': 'Images',
@@ -22,70 +26,88 @@ BY_TYPE_SIZE_KEYS = {'total_image_size': 'Images',
 
 
 StrOrFloat = TypeVar('StrOrFloat', str, float)
+T = TypeVar('T')
 
 
 class StatCollector:
     """This object collects statistics about reposted posts."""
 
-    def _get_day_stats(self, day: str, db_suffix: str) -> Dict[str, float]:
+    def _day_query(self, day: str, db_suffix: str) -> Tuple[str, str, str]:
         cur_key = f"{self._db_prefix}_date_{db_suffix}"
         cur_key_size = f"{self._db_prefix}_date_size_{db_suffix}"
 
-        return self._get_totals_generic(cur_key, cur_key_size, f"{day}_")
+        return cur_key, cur_key_size, f"{day}_"
 
-    def _get_totals(self, db_suffix: str) -> Dict[str, float]:
-        cur_key = f"{self._db_prefix}_total_{db_suffix}"
-        cur_key_size = f"{self._db_prefix}_total_size_{db_suffix}"
+    def _get_day_stats(self, day: str, db_suffix: str) -> Dict[str, float]:
+        return self._get_totals_generic(*self._day_query(day, db_suffix))
 
-        return self._get_totals_generic(cur_key, cur_key_size, "")
+    def _get_totals(self, db_suffix: str) -> Dict[str, float]:
+        return self._get_totals_generic(*self._totals_query(db_suffix))
 
     def _get_totals_generic(self, cur_key: str, cur_key_size: str, cur_hkey_prefix: str) -> Dict[str, float]:
+        return self._get_totals_many([(cur_key, cur_key_size, cur_hkey_prefix)])[0]
+
+    def _get_totals_many(self, queries: List[Tuple[str, str, str]]) -> List[Dict[str, float]]:
+        # All the hash fields of all the queries are fetched in a single round-trip
+        with self._redis.pipeline(transaction=False) as pipe:
+            for cur_key, cur_key_size, cur_hkey_prefix in queries:
+                cur_hkeys = [f"{cur_hkey_prefix}{media_type.name.lower()}" for media_type in TelegramMediaType]
+                pipe.hmget(cur_key, cur_hkeys)
+                pipe.hmget(cur_key_size, cur_hkeys)
+            fetched = pipe.execute()
+
+        return [StatCollector._build_totals(fetched[i], fetched[i + 1]) for i in range(0, len(fetched), 2)]
+
+    @staticmethod
+    def _build_totals(values: List[Optional[bytes]], size_values: List[Optional[bytes]]) -> Dict[str, float]:
         res = {}
 
         total = 0
         total_size = 0
-        for media_type in TelegramMediaType:
-            cur_hkey = f"{cur_hkey_prefix}{media_type.name.lower()}"
+        for media_type, val, size_val in zip(TelegramMediaType, values, size_values):
             media_type_str = media_type.name.lower()
 
-            val = self._get_val_if_exists(cur_key, cur_hkey)
+            val = float(val) if val is not None else 0
             res[f'total_{media_type_str}'] = val
             total += val
 
-            val = self._get_val_if_exists(cur_key_size, cur_hkey)
-            res[f'total_{media_type_str}_size'] = val
-            total_size += val
+            size_val = float(size_val) if size_val is not None else 0
+            res[f'total_{media_type_str}_size'] = size_val
+            total_size += size_val
 
         res['total'] = total
         res['total_size'] = total_size
 
         return res
 
-    def _get_val_if_exists(self, key: str, hkey: str) -> float:
-        if not self._redis.hexists(key, hkey):
-            return 0
-        return float(self._redis.hget(key, hkey))
-
     def _get_week_stats(self, db_suffix: str) -> List[Tuple[str, Dict[str, float]]]:
+        days = StatCollector._week_days()
+        return list(zip(days, self._get_totals_many([self._day_query(day, db_suffix) for day in days])))
+
+    def _totals_query(self, db_suffix: str) -> Tuple[str, str, str]:
+        cur_key = f"{self._db_prefix}_total_{db_suffix}"
+        cur_key_size = f"{self._db_prefix}_total_size_{db_suffix}"
+
+        return cur_key, cur_key_size, ""
+
+    @staticmethod
+    def _week_days() -> List[str]:
         res = []
         start = datetime.date.today() - datetime.timedelta(days=6)
         today = datetime.date.today()
 
         while start <= today:
-            day_str = str(start)
-            res.append((day_str, self._get_day_stats(day_str, db_suffix)))
-
+            res.append(str(start))
             start += datetime.timedelta(days=1)
 
         return res
 
-    def _record_media_stats(self, file_path: str, db_suffix: str):
-
-        def increment_hash_value(key: str, hkey: str, value):
-            if not self._redis.hexists(key, hkey):
-                self._redis.hset(key, hkey, 0)
-            self._redis.hincrbyfloat(key, hkey, value)
+    def _flush_worker(self):
+        logging.debug("Stats flush thread started.")
+        while not self._flush_stop.wait(self._flush_interval):
+            self.flush()
 
+    def _record_media_stats(self, file_path: str, db_suffix: str):
         file_size = round(os.path.getsize(file_path) / 10 ** 6, 3)  # to megabyte
         media_type = TelegramHelper.determine_media_type(file_path).name.lower()
         today = str(datetime.date.today())
@@ -93,24 +115,38 @@ class StatCollector:
         logging.debug(f"Recording media statistics: type - {media_type}, size - {file_size}, date - {today}, "
                       f"action - {db_suffix}")
 
-        # Total media reposted
-        cur_key = f"{self._db_prefix}_total_{db_suffix}"
-        increment_hash_value(cur_key, media_type, 1)
-
-        # Total media size
-        cur_key = f"{self._db_prefix}_total_size_{db_suffix}"
-        increment_hash_value(cur_key, media_type, file_size)
-
-        # Total media reposted today
-        cur_key = f"{self._db_prefix}_date_{db_suffix}"
-        cur_hkey = f"{today}_{media_type}"
-        increment_hash_value(cur_key, cur_hkey, 1)
-
-        # Total media size reposted today
-        media_type = TelegramHelper.determine_media_type(file_path).name.lower()
-        cur_key = f"{self._db_prefix}_date_size_{db_suffix}"
-        cur_hkey = f"{today}_{media_type}"
-        increment_hash_value(cur_key, cur_hkey, file_size)
+        self._record_increments({
+            # Total media reposted
+            (f"{self._db_prefix}_total_{db_suffix}", media_type): 1,
+            # Total media size
+            (f"{self._db_prefix}_total_size_{db_suffix}", media_type): file_size,
+            # Total media reposted today
+            (f"{self._db_prefix}_date_{db_suffix}", f"{today}_{media_type}"): 1,
+            # Total media size reposted today
+            (f"{self._db_prefix}_date_size_{db_suffix}", f"{today}_{media_type}"): file_size,
+        })
+
+    def _record_increments(self, increments: Dict[Tuple[str, str], float]):
+        if self._flush_every > 0:
+            with self._buffer_lock:
+                for key, value in increments.items():
+                    self._buffer[key] = self._buffer.get(key, 0) + value
+                self._buffered_events += 1
+                flush_now = self._buffered_events >= self._flush_every
+            if flush_now:
+                self.flush()
+        else:
+            self._write_increments(increments)
+
+    def _write_increments(self, increments: Dict[Tuple[str, str], float]):
+        # HINCRBYFLOAT creates missing fields, so all the counters are updated atomically in a single round-trip
+        with self._redis.pipeline(transaction=True) as pipe:
+            for (key, hkey), value in increments.items():
+                pipe.hincrbyfloat(key, hkey, value)
+            pipe.execute()
+        # Bumped only once the counters are in DB, so a value cached in between is not kept as up to date
+        with self._buffer_lock:
+            self._version += 1
 
     def __del__(self):
         logging.debug(f"Deleting StatCollector object.")
@@ -119,16 +155,82 @@ class StatCollector:
 
     def __init__(self,
                  redis_db: Redis,
-                 db_prefix: str):
+                 db_prefix: str,
+                 flush_every: int = 0,
+                 flush_interval: float = 10):
         """Initialize StatCollector object
         Args:
             redis_db: Redis DB instance. To store reposted posts statistics.
             db_prefix: DB key prefix.
+            flush_every: If greater than 0 - counters are buffered in memory and written to DB every flush_every
+                recorded events or every flush_interval seconds, whichever comes first. If 0 - every event is written
+                immediately.
+            flush_interval: Max delay in seconds before buffered counters are written to DB.
         """
         self._redis = redis_db
         self._db_prefix = db_prefix
 
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._buffer = {}
+        self._buffered_events = 0
+        self._buffer_lock = threading.Lock()
+        self._version = 0
+
+        self._flush_stop = None
+        self._flush_thread = None
+        if self._flush_every > 0:
+            self._flush_stop = threading.Event()
+            self._flush_thread = threading.Thread(target=self._flush_worker, args=())
+            self._flush_thread.start()
+
     # Public methods
+    def get_all_stats(self) -> Dict[str, object]:
+        """Get today, week and total stats of both sent and delivered messages in a single DB round-trip.
+
+        Returns:
+            A dictionary containing next keys:
+                'today_sent', 'today_delivered' - dicts similar to one returned by get_today_sent.
+                'week_sent', 'week_delivered' - lists similar to one returned by get_week_sent.
+                'totals_sent', 'totals_delivered' - dicts similar to one returned by get_totals_sent.
+        """
+        logging.debug("Getting all stats on sent and delivered messages")
+        today = str(datetime.date.today())
+        days = StatCollector._week_days()
+
+        queries = []
+        for db_suffix in ("sent", "delivered"):
+            queries.append(self._day_query(today, db_suffix))
+            queries += [self._day_query(day, db_suffix) for day in days]
+            queries.append(self._totals_query(db_suffix))
+        fetched = self._get_totals_many(queries)
+
+        res = {}
+        step = len(days) + 2
+        for i, db_suffix in enumerate(("sent", "delivered")):
+            cur = fetched[i * step:(i + 1) * step]
+            res[f'today_{db_suffix}'] = cur[0]
+            res[f'week_{db_suffix}'] = list(zip(days, cur[1:-1]))
+            res[f'totals_{db_suffix}'] = cur[-1]
+        return res
+
+    @property
+    def db_prefix(self) -> str:
+        """DB key prefix of the collected statistics."""
+        return self._db_prefix
+
+    def flush(self):
+        """Write buffered counters to DB. Does nothing if buffering is disabled."""
+        with self._buffer_lock:
+            increments = self._buffer
+            events = self._buffered_events
+            self._buffer = {}
+            self._buffered_events = 0
+
+        if len(increments) > 0:
+            logging.debug(f"Flushing statistics of {events} buffered events.")
+            self._write_increments(increments)
+
     def get_today_delivered(self) -> Dict[str, float]:
         """Get stats of delivered messages today.
 
@@ -183,6 +285,21 @@ class StatCollector:
         logging.debug("Getting stats on all sent messages")
         return self._get_totals("sent")
 
+    def get_totals_optimized(self) -> Dict[str, float]:
+        """Get total stats of media optimized before sending.
+
+        Returns:
+            A dictionary containing next keys:
+                'total_[image|video|animation|document|audio]' - number of optimized files by original media type.
+                'total_[image|video|animation|document|audio]_saved_size' - size saved in megabytes by media type.
+                'total_[image|video|animation|document|audio]_time' - time spent optimizing in seconds by media type.
+        """
+        logging.debug("Getting stats on optimized media")
+        fields = [f"{media_type.name.lower()}{suffix}"
+                  for media_type in TelegramMediaType for suffix in ('', '_saved_size', '_time')]
+        values = self._redis.hmget(f"{self._db_prefix}_total_optimized", fields)
+        return {f'total_{field}': float(value) if value is not None else 0 for field, value in zip(fields, values)}
+
     def get_week_delivered(self) -> List[Tuple[str, Dict[str, float]]]:
         """Get stats of delivered messages last week.
 
@@ -212,6 +329,24 @@ class StatCollector:
         """
         self._record_media_stats(file_path, "delivered")
 
+    def record_media_optimized(self, file_path: str, original_size: int, optimized_size: int, elapsed: float):
+        """Record to the database the result of a media optimization before sending.
+        Args:
+            file_path: Path to the original media file. Determines the media type.
+            original_size: Size of the original file in bytes.
+            optimized_size: Size of the optimized file in bytes.
+            elapsed: Time in seconds spent optimizing.
+        """
+        media_type = TelegramHelper.determine_media_type(file_path).name.lower()
+        saved_size = round((original_size - optimized_size) / 10 ** 6, 3)  # to megabyte
+        logging.debug(f"Recording optimization statistics: type - {media_type}, saved - {saved_size}, "
+                      f"time - {elapsed:.3f}")
+
+        key = f"{self._db_prefix}_total_optimized"
+        self._record_increments({(key, media_type): 1,
+                                 (key, f"{media_type}_saved_size"): saved_size,
+                                 (key, f"{media_type}_time"): round(elapsed, 3)})
+
     def record_media_sent(self, file_path: str):
         """Record to the database all the statistics when the message has been sent.
         Args:
@@ -219,6 +354,62 @@ class StatCollector:
         """
         self._record_media_stats(file_path, "sent")
 
+    @property
+    def version(self) -> int:
+        """Number of writes of recorded events to DB. Changes every time new statistics reach DB."""
+        return self._version
+
+    def stop(self):
+        """Stop the buffered counters flush thread and write the remaining counters to DB."""
+        logging.debug(f"Stopping StatCollector object.")
+        if self._flush_stop is not None:
+            self._flush_stop.set()
+            self._flush_thread.join()
+            self._flush_stop = None
+            self._flush_thread = None
+        self.flush()
+
+
+class StatsCache:
+    """Caches values computed from StatCollector statistics for a short time. A cached value is invalidated when its
+    TTL expires or when the StatCollector records a new event."""
+
+    def __init__(self, ttl: float = 10):
+        """Initialize StatsCache object
+        Args:
+            ttl: Time in seconds for which a computed value stays valid.
+        """
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def get(self, stat_collector: StatCollector, compute: Callable[[StatCollector], T]) -> Tuple[T, str]:
+        """Get a cached value or compute a new one.
+
+        Args:
+            stat_collector: StatCollector object the value is computed from.
+            compute: Function computing the value. StatCollector object is passed as an argument.
+        Returns:
+            A tuple of the value and its ETag. The ETag changes only if the value changes.
+        """
+        version = stat_collector.version
+        with self._lock:
+            if self._entry is not None:
+                entry_version, expires, value, etag = self._entry
+                if entry_version == version and time.time() < expires:
+                    return value, etag
+
+        value = compute(stat_collector)
+        etag = hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            self._entry = (version, time.time() + self._ttl, value, etag)
+        return value, etag
+
+    def invalidate(self):
+        """Drop the cached value."""
+        with self._lock:
+            self._entry = None
+
 
 class DataExtractor:
     """Object that provides utility methods to extract specific data from data fetched from DB"""
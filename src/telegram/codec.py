@@ -0,0 +1,86 @@
+"""A module containing the JSON codec used to exchange objects with the TDLib JSON library. A faster JSON library is
+used if installed."""
+import json
+import logging
+import re
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TdJsonCodec:
+    """Encodes TDLib requests and decodes TDLib responses and updates. With orjson, no intermediate str objects are
+    created."""
+
+    _type_re = re.compile(rb'"@type"\s*:\s*"([^"]+)"')
+    _type_prefix = b'{"@type":"'
+
+    def __init__(self, backend: Optional[str] = None):
+        """Initialize TdJsonCodec object.
+
+        Args:
+            backend: JSON library to use: 'orjson' or 'json'. If None - orjson is used if installed.
+
+        Raises:
+            ModuleNotFoundError: Requested JSON library is not installed.
+        """
+        if backend is None:
+            backend = 'orjson' if orjson is not None else 'json'
+
+        if backend == 'orjson':
+            if orjson is None:
+                raise ModuleNotFoundError("orjson is not installed.")
+            self.decode = orjson.loads
+            self.encode = orjson.dumps
+        else:
+            self.decode = TdJsonCodec._json_decode
+            self.encode = TdJsonCodec._json_encode
+
+        self._backend = backend
+        logging.debug(f"TDLib JSON codec uses {backend}.")
+
+    @staticmethod
+    def _json_decode(data: bytes):
+        # json.loads detects the encoding of bytes input, decoding explicitly is faster
+        return json.loads(data.decode('utf-8'))
+
+    @staticmethod
+    def _json_encode(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    @property
+    def backend(self) -> str:
+        """Name of the JSON library in use."""
+        return self._backend
+
+    @staticmethod
+    def has_extra(data: bytes) -> bool:
+        """Check whether a serialized object may be a response to a request tagged with @extra.
+
+        Args:
+            data: Serialized TDLib object.
+        Returns:
+            bool: False if the object definitely has no @extra field.
+        """
+        return b'"@extra"' in data
+
+    @staticmethod
+    def peek_type(data: bytes) -> Optional[str]:
+        """Get the '@type' of a serialized TDLib object without parsing it.
+
+        Args:
+            data: Serialized TDLib object.
+        Returns:
+            str or None: The object '@type'. None if not found.
+        """
+        # TDLib writes '@type' as the first field, so the regular expression is only a fallback
+        if data.startswith(TdJsonCodec._type_prefix):
+            end = data.find(b'"', len(TdJsonCodec._type_prefix))
+            if end > 0:
+                return data[len(TdJsonCodec._type_prefix):end].decode('utf-8')
+
+        match = TdJsonCodec._type_re.search(data)
+        return match.group(1).decode('utf-8') if match is not None else None
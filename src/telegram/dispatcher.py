@@ -0,0 +1,101 @@
+"""A module containing an object that runs callbacks on worker threads, so the TDLib receiver thread is never blocked
+by slow subscribers."""
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict
+
+
+class CallbackDispatcher:
+    """Runs callbacks on a pool of worker threads fed by a bounded queue. When the queue is full, the dispatching
+    thread waits for a free slot, which applies back-pressure to the producer."""
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            callback, arg = item
+            try:
+                callback(arg)
+            except Exception:
+                logging.exception(f"Callback {callback} failed.")
+            finally:
+                with self._stats_lock:
+                    self._completed += 1
+                self._queue.task_done()
+
+    def __init__(self, workers: int = 2, queue_size: int = 1000):
+        """Initialize CallbackDispatcher object.
+
+        Args:
+            workers: Number of worker threads running callbacks.
+            queue_size: Max number of callbacks waiting to be run.
+        """
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self._stats_lock = threading.Lock()
+        self._dispatched = 0
+        self._completed = 0
+        self._max_queue_depth = 0
+        self._blocked_puts = 0
+        self._blocked_time = 0.0
+
+        self._workers = [threading.Thread(target=self._worker, args=(), name=f'CallbackDispatcher-{i}')
+                         for i in range(max(1, workers))]
+        for worker in self._workers:
+            worker.start()
+
+    def dispatch(self, callback: Callable[[Any], None], arg: Any):
+        """Queue a callback to be run on a worker thread. Blocks while the queue is full.
+
+        Args:
+            callback: Callback function.
+            arg: Argument passed to the callback.
+        """
+        blocked_time = None
+        try:
+            self._queue.put_nowait((callback, arg))
+        except queue.Full:
+            put_start = time.perf_counter()
+            self._queue.put((callback, arg))
+            blocked_time = time.perf_counter() - put_start
+
+        with self._stats_lock:
+            self._dispatched += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+            if blocked_time is not None:
+                self._blocked_puts += 1
+                self._blocked_time += blocked_time
+
+    def stats(self) -> Dict[str, float]:
+        """Get dispatching and back-pressure statistics.
+
+        Returns:
+            A dictionary containing next keys:
+                'queue_depth'     - number of callbacks waiting to be run.
+                'max_queue_depth' - max observed number of callbacks waiting to be run.
+                'dispatched'      - total number of dispatched callbacks.
+                'completed'       - total number of finished callbacks.
+                'blocked_puts'    - number of times the dispatching thread waited for a free queue slot.
+                'blocked_time'    - total time in seconds the dispatching thread waited for a free queue slot.
+        """
+        with self._stats_lock:
+            return {'queue_depth': self._queue.qsize(),
+                    'max_queue_depth': self._max_queue_depth,
+                    'dispatched': self._dispatched,
+                    'completed': self._completed,
+                    'blocked_puts': self._blocked_puts,
+                    'blocked_time': self._blocked_time}
+
+    def stop(self):
+        """Run all the queued callbacks and stop the worker threads."""
+        logging.debug(f"Stopping CallbackDispatcher object.")
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
@@ -0,0 +1,285 @@
+"""A module containing an object that schedules outbound TDLib chat requests, so the Telegram flood limits are not
+exceeded."""
+from collections import deque
+from concurrent.futures import Future
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class _ChatQueue:
+    """Pending requests and the token bucket of a single chat."""
+
+    def __init__(self, rate: float, burst: int):
+        self.jobs = deque()
+        self.rate = rate
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float, burst: int):
+        self.tokens = min(float(burst), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, now: float) -> float:
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+
+class _Job:
+    """A request waiting to be sent."""
+
+    def __init__(self, query: dict):
+        self.query = query
+        self.future = Future()
+        self.attempts = 0
+        # Temporary IDs of the messages of the last attempt, in the order of the message contents
+        self.message_ids: List[int] = []
+        # Temporary message ID -> (error code, error message, retry after) of the finished messages, None on success
+        self.results: Dict[int, Optional[Tuple[Optional[int], str, float]]] = {}
+        self.failed_messages: Dict[int, dict] = {}
+
+
+class SendScheduler:
+    """Sends chat requests through a token bucket per chat. Requests rejected by Telegram with 429 / FLOOD_WAIT_X are
+    retried after the requested delay, and the rate of the chat is halved. Every successful request raises the rate
+    back, up to the configured one, so the scheduler converges to the highest rate Telegram accepts.
+
+    TDLib accepts a message request at once with a pending message, the flood limit error usually arrives later with
+    updateMessageSendFailed. Such updates are passed to process_send_result, which retries the failed messages, and
+    only updateMessageSendSucceeded counts as a success."""
+
+    _retry_after_re = re.compile(r'(?:retry after |FLOOD_WAIT_)(\d+)')
+
+    def _collect_ready(self):
+        # Must be called with self._cond acquired
+        now = time.monotonic()
+        ready = []
+        timeout = None
+        for chat_id, chat in self._chats.items():
+            if len(chat.jobs) == 0:
+                continue
+            chat.refill(now, self._burst)
+            wait = chat.wait_time(now)
+            if wait <= 0:
+                chat.tokens -= 1
+                ready.append((chat_id, chat.jobs.popleft()))
+            else:
+                timeout = wait if timeout is None else min(timeout, wait)
+        return ready, timeout
+
+    def _finish_messages(self, chat_id: int, job: _Job):
+        # All the messages of the attempt are finished. Messages failed with a flood limit or a server error are
+        # retried, the sent ones are not sent again.
+        retry_ids = [x for x in job.message_ids if job.results[x] is not None and
+                     SendScheduler._is_retryable(job.results[x][0])]
+        final_ids = [x for x in job.message_ids if job.results[x] is not None and x not in retry_ids]
+        if len(retry_ids) > 0 and job.attempts >= self._max_retries:
+            final_ids += retry_ids
+            retry_ids = []
+
+        for message_id in final_ids:
+            code, message, _ = job.results[message_id]
+            logging.error(f"Chat {chat_id} message {message_id} failed: {code} - {message}")
+            self._send_failed(job.failed_messages[message_id])
+
+        if len(retry_ids) > 0:
+            code = max(job.results[x][0] for x in retry_ids)
+            retry_after = max(job.results[x][2] for x in retry_ids)
+            if job.query['@type'] == 'sendMessageAlbum':
+                contents = job.query['input_message_contents']
+                job.query = dict(job.query)
+                job.query['input_message_contents'] = [contents[job.message_ids.index(x)] for x in retry_ids]
+            self._retry(chat_id, job, code, retry_after)
+
+    @staticmethod
+    def _is_retryable(code: Optional[int]) -> bool:
+        return code == 429 or (code is not None and code >= 500)
+
+    def _on_response(self, chat_id: int, job: _Job, response: Future):
+        error = response.exception()
+        if error is None:
+            result = response.result()
+            if result.get('@type') == 'messages':
+                messages = [x for x in result['messages'] if x is not None]
+            elif result.get('@type') == 'message':
+                messages = [result]
+            else:
+                messages = []
+            with self._cond:
+                if len(messages) > 0:
+                    # The result is known once TDLib reports updateMessageSendSucceeded or updateMessageSendFailed
+                    job.message_ids = [x['id'] for x in messages]
+                    job.results = {}
+                    job.failed_messages = {}
+                    for message_id in job.message_ids:
+                        self._sending[message_id] = (chat_id, job)
+                else:
+                    chat = self._chats[chat_id]
+                    chat.rate = min(self._rate, chat.rate + self._rate * 0.05)
+            if not job.future.done():
+                job.future.set_result(result)
+            return
+
+        code = getattr(error, 'code', None)
+        if SendScheduler._is_retryable(code) and job.attempts < self._max_retries:
+            match = SendScheduler._retry_after_re.search(str(error))
+            retry_after = int(match.group(1)) if match is not None else self._backoff * 2 ** job.attempts
+            self._retry(chat_id, job, code, retry_after)
+        elif not job.future.done():
+            job.future.set_exception(error)
+        else:
+            # A retry of messages which already failed once is rejected, the messages are lost
+            logging.error(f"Chat {chat_id} request retry rejected: {error}")
+            for message in job.failed_messages.values():
+                self._send_failed(message)
+
+    def _retry(self, chat_id: int, job: _Job, code: int, retry_after: float):
+        job.attempts += 1
+        logging.warning(f"Chat {chat_id} request rejected with {code}. Retrying in {retry_after} s, "
+                        f"attempt {job.attempts}.")
+        with self._cond:
+            chat = self._chats[chat_id]
+            chat.blocked_until = max(chat.blocked_until, time.monotonic() + retry_after)
+            if code == 429:
+                chat.rate = max(self._rate / 16, chat.rate / 2)
+            chat.jobs.appendleft(job)
+            self._cond.notify()
+
+    def _send_job(self, chat_id: int, job: _Job):
+        try:
+            response = self._send(job.query)
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        response.add_done_callback(lambda x: self._on_response(chat_id, job, x))
+
+    def _worker(self):
+        logging.debug("Send scheduler thread started.")
+        while True:
+            with self._cond:
+                ready, timeout = self._collect_ready()
+                while len(ready) == 0 and not self._stop:
+                    self._cond.wait(timeout)
+                    ready, timeout = self._collect_ready()
+                if self._stop:
+                    break
+
+            for chat_id, job in ready:
+                self._send_job(chat_id, job)
+
+        with self._cond:
+            for chat in self._chats.values():
+                for job in chat.jobs:
+                    job.future.cancel()
+                chat.jobs.clear()
+
+    def __init__(self,
+                 send: Callable[[dict], Future],
+                 send_failed: Callable[[dict], None],
+                 rate: float = 0.3,
+                 burst: int = 5,
+                 max_retries: int = 5,
+                 backoff: float = 1.0):
+        """Initialize SendScheduler object.
+
+        Args:
+            send: Function sending a request and returning a future of the response.
+            send_failed: Function called with the message of updateMessageSendFailed once the message is not retried
+                any more.
+            rate: Max number of requests per second sent to a single chat.
+            burst: Max number of requests sent to a single chat at once after an idle period.
+            max_retries: Max number of retries of a request rejected with 429 or a server error.
+            backoff: Base retry delay in seconds if the error does not specify one. Doubles with every retry.
+        """
+        self._send = send
+        self._send_failed = send_failed
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._max_retries = max_retries
+        self._backoff = backoff
+
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._sending: Dict[int, Tuple[int, _Job]] = {}  # temporary message ID -> (chat ID, job)
+        self._cond = threading.Condition()
+        self._stop = False
+        self._worker_thread = threading.Thread(target=self._worker, args=(), name='SendScheduler')
+        self._worker_thread.start()
+
+    def process_send_result(self, update: dict):
+        """Process the result of a sent message.
+
+        Args:
+            update: updateMessageSendSucceeded or updateMessageSendFailed TDLib update.
+        """
+        succeeded = update['@type'] == 'updateMessageSendSucceeded'
+        result = None
+        if not succeeded:
+            # Older TDLib versions report error_code and error_message instead of an error object
+            error = update.get('error') or {'code': update.get('error_code'),
+                                            'message': update.get('error_message', '')}
+            match = SendScheduler._retry_after_re.search(error.get('message') or '')
+            retry_after = update['message'].get('sending_state', {}).get('retry_after', 0)
+            retry_after = int(match.group(1)) if match is not None else retry_after
+            result = (error.get('code'), error.get('message') or '', retry_after)
+
+        with self._cond:
+            chat_id, job = self._sending.pop(update['old_message_id'], (None, None))
+            if job is None:
+                finished = False
+            else:
+                job.results[update['old_message_id']] = result
+                if not succeeded:
+                    job.failed_messages[update['old_message_id']] = update['message']
+                    if result[2] <= 0:
+                        result = (result[0], result[1], self._backoff * 2 ** job.attempts)
+                        job.results[update['old_message_id']] = result
+                else:
+                    chat = self._chats[chat_id]
+                    chat.rate = min(self._rate, chat.rate + self._rate * 0.05)
+                finished = len(job.results) == len(job.message_ids)
+
+        if job is None:
+            if not succeeded:
+                self._send_failed(update['message'])
+        elif finished:
+            self._finish_messages(chat_id, job)
+
+    def queue_depth(self, chat_id: Optional[int] = None) -> int:
+        """Get the number of requests waiting to be sent.
+
+        Args:
+            chat_id: ID of the chat. If None - the total over all the chats is returned.
+        Returns:
+            int: Number of requests waiting to be sent.
+        """
+        with self._cond:
+            if chat_id is not None:
+                return len(self._chats[chat_id].jobs) if chat_id in self._chats else 0
+            return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def stop(self):
+        """Stop the scheduler thread. Requests waiting to be sent are cancelled."""
+        logging.debug(f"Stopping SendScheduler object.")
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._worker_thread.join()
+
+    def submit(self, chat_id: int, query: dict) -> Future:
+        """Queue a chat request.
+
+        Args:
+            chat_id: ID of the target chat.
+            query: TDLib request object.
+        Returns:
+            Future: Resolved with the TDLib response once the request is accepted.
+        """
+        job = _Job(query)
+        with self._cond:
+            if chat_id not in self._chats:
+                self._chats[chat_id] = _ChatQueue(self._rate, self._burst)
+            self._chats[chat_id].jobs.append(job)
+            self._cond.notify()
+        return job.future
@@ -2,15 +2,22 @@
 A module containing an object that wraps the C td_json_client object and provides a Python interface to access some of
 its methods.
 """
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeoutError
 from ctypes.util import find_library
 from ctypes import *
 from enum import Enum
-import json
+import itertools
 import logging
+from metrics import TDLIB_SEND_SECONDS
 import os
 import platform
+from telegram.codec import TdJsonCodec
+from telegram.dispatcher import CallbackDispatcher
+from telegram.send_scheduler import SendScheduler
 import threading
-from typing import List, Tuple, Callable
+import time
+from typing import Dict, List, Optional, Tuple, Callable
 
 
 def on_fatal_error_callback(error_message: str):
@@ -26,6 +33,15 @@ class TelegramAuthError(Exception):
     """Error raised in case of Telegram authentication error"""
 
 
+class TelegramRequestError(Exception):
+    """Error raised in case TDLib responded to a request with an error"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} - {message}")
+        self.code = code
+        self.message = message
+
+
 class TelegramAuthState(Enum):
     """Authentication states for TelegramWrapper object"""
     WAIT_REQUEST = 0
@@ -58,6 +74,8 @@ class TelegramWrapper:
     """Object to access td_json_client methods via Python code.
     """
 
+    max_tracked_sends = 10000  # messages waiting for the send result, the oldest are forgotten when exceeded
+
     def _init_log_handling(self, tdlib_log_verbosity: int, tdlib_log_file: str, tdlib_log_max_size: int):
         result = self._td_client_execute({'@type': 'setLogVerbosityLevel',
                                           'new_verbosity_level': tdlib_log_verbosity})
@@ -114,10 +132,32 @@ class TelegramWrapper:
                        'supports_streaming': True}
         return content
 
+    @staticmethod
+    def _get_input_media_paths(query: dict) -> List[str]:
+        contents = query['input_message_contents'] if 'input_message_contents' in query else \
+            [query.get('input_message_content', {})]
+        return [x['path'] for content in contents for x in content.values()
+                if isinstance(x, dict) and x.get('@type') == 'inputFileLocal']
+
+    def _process_request_result(self, query: dict, future: Future):
+        # Requests rejected by TDLib never produce a message, so updateMessageSendFailed is not received for them
+        if not future.cancelled() and future.exception() is None:
+            return
+        logging.error(f"TDLib JSON {query['@type']} request failed: "
+                      f"{'cancelled' if future.cancelled() else repr(future.exception())}")
+        for path in TelegramWrapper._get_input_media_paths(query):
+            for callback in tuple(self._request_failed_callbacks):
+                self._run_callback(callback, path)
+
+    def _notify_message_failed(self, message: dict):
+        logging.debug(f"Message failed: {message}")
+        for callback in tuple(self._message_failed_callbacks):
+            self._run_callback(callback, message)
+
     def _notify_message_sent(self, message: dict):
         logging.debug(f"Message sent: {message}")
-        for callback in self._message_sent_callbacks:
-            callback(message)
+        for callback in tuple(self._message_sent_callbacks):
+            self._run_callback(callback, message)
         logging.debug(f"Message sent: All subscribers notified.")
 
     def _process_authorization(self, auth_state: dict):
@@ -146,46 +186,147 @@ class TelegramWrapper:
             logging.info("TelegramWrapper ready!")
             self._auth_state = TelegramAuthState.READY
 
+    def _process_message_send_result(self, event: dict):
+        # Messages are correlated by the temporary ID returned in the response to the send request
+        succeeded = event['@type'] == 'updateMessageSendSucceeded'
+        send_time = self._sending_messages.pop(event['old_message_id'], None)
+        if send_time is not None:
+            TDLIB_SEND_SECONDS.observe(time.perf_counter() - send_time, result='succeeded' if succeeded else 'failed')
+        if succeeded:
+            self._notify_message_sent(event['message'])
+        if self._scheduler is not None:
+            # Messages failed because of the flood limits are retried by the scheduler
+            self._scheduler.process_send_result(event)
+        elif not succeeded:
+            self._notify_message_failed(event['message'])
+
+    def _process_error(self, event: dict):
+        logging.error(f'Telegram error received: {event["code"]} - {event["message"]}')
+
+    def _process_new_chat(self, event: dict):
+        chat_title = event['chat']['title']
+        chat_id = event['chat']['id']
+        logging.debug(f"TDLib JSON: chat ID saved: {chat_title}:{chat_id}")
+        with self._chat_id_map_lock:
+            self._chat_id_map[chat_title] = chat_id
+
+    def _resolve_request(self, event: dict):
+        with self._pending_requests_lock:
+            pending = self._pending_requests.pop(event['@extra'], None)
+        if pending is None:
+            return
+
+        future, send_time = pending
+        self._in_flight.release()
+        latency = time.perf_counter() - send_time
+        with self._request_stats_lock:
+            self._request_stats['completed'] += 1
+            self._request_stats['total_latency'] += latency
+            if event['@type'] == 'error':
+                self._request_stats['failed'] += 1
+
+        if event['@type'] in ('message', 'messages'):
+            messages = event['messages'] if event['@type'] == 'messages' else [event]
+            for message in messages:
+                if message is not None:
+                    self._sending_messages[message['id']] = send_time
+            while len(self._sending_messages) > TelegramWrapper.max_tracked_sends:
+                self._sending_messages.popitem(last=False)
+
+        if event['@type'] == 'error':
+            future.set_exception(TelegramRequestError(event['code'], event['message']))
+        else:
+            future.set_result(event)
+
+    def _run_callback(self, callback: Callable[[dict], None], arg: dict):
+        # Subscriber callbacks are run on dispatcher threads, if enabled, so they never block the receiver thread
+        if self._dispatcher is not None:
+            self._dispatcher.dispatch(callback, arg)
+        else:
+            callback(arg)
+
+    def _send_tracked(self, query: dict, kwargs: dict) -> bool:
+        # Waits for the TDLib response only if the caller specified a timeout
+        if self._scheduler is not None and 'chat_id' in query:
+            future = self._scheduler.submit(query['chat_id'], query)
+        else:
+            future = self._td_client_send(query, track=True)
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            future.add_done_callback(lambda x: self._process_request_result(query, x))
+            return True
+        try:
+            future.result(timeout)
+        except (FutureTimeoutError, CancelledError, TelegramRequestError) as e:
+            logging.warning(f"TDLib JSON {query['@type']} request not confirmed: {e!r}")
+            return False
+        return True
+
     def _td_client_execute(self, query):
-        query = json.dumps(query).encode('utf-8')
+        query = self._codec.encode(query)
         result = self._client_execute(self._client, query)
         if result:
-            result = json.loads(result.decode('utf-8'))
+            result = self._codec.decode(result)
         return result
 
-    def _td_client_receive(self):
-        result = self._client_receive(self._client, 1.0)
-        if result:
-            result = json.loads(result.decode('utf-8'))
-        return result
-
-    def _td_client_send(self, query):
-        query = json.dumps(query).encode('utf-8')
+    def _td_client_receive(self, timeout: float) -> Optional[bytes]:
+        # Returns a serialized object, so it can be skipped without parsing
+        return self._client_receive(self._client, timeout)
+
+    def _td_client_send(self, query, track: bool = False) -> Optional[Future]:
+        future = None
+        if track:
+            # The request is tagged with an @extra ID, TDLib copies it to the response
+            self._in_flight.acquire()
+            extra = str(next(self._extra_counter))
+            query = dict(query)
+            query['@extra'] = extra
+            future = Future()
+            with self._pending_requests_lock:
+                self._pending_requests[extra] = (future, time.perf_counter())
+            with self._request_stats_lock:
+                self._request_stats['sent'] += 1
+
+        query = self._codec.encode(query)
         self._client_send(self._client, query)
+        return future
 
     def _td_receive_handler(self):
         logging.debug(f"TDLib JSON message receiver thread started.")
+        timeout = self._receive_timeout_min
         while not self._receive_handler_stop.is_set():
-            event = self._td_client_receive()
-
-            if event:
-                # In the next section all of incoming messages should be processed
-                # print(event)
-                if event['@type'] == 'updateNewChat':
-                    chat_title = event['chat']['title']
-                    chat_id = event['chat']['id']
-                    logging.debug(f"TDLib JSON: chat ID saved: {chat_title}:{chat_id}")
-                    with self._chat_id_map_lock:
-                        self._chat_id_map[chat_title] = chat_id
-
-                elif event['@type'] == 'updateMessageSendSucceeded':
-                    self._notify_message_sent(event['message'])
-
-                elif event['@type'] == 'updateAuthorizationState':
-                    self._process_authorization(event['authorization_state'])
-
-                elif event['@type'] == 'error':
-                    logging.error(f'Telegram error received: {event["code"]} - {event["message"]}')
+            wait_start = time.perf_counter()
+            data = self._td_client_receive(timeout)
+            handle_start = time.perf_counter()
+            self._receive_wait_time += handle_start - wait_start
+
+            if data:
+                # Receive returns as soon as an event is available. The timeout only matters while idle.
+                timeout = self._receive_timeout_min
+                event_type = self._codec.peek_type(data)
+                handler = self._update_handlers.get(event_type)
+                callbacks = self._update_subscribers.get(event_type, ())
+
+                skipped = handler is None and len(callbacks) == 0 and not self._codec.has_extra(data)
+                if not skipped:
+                    try:
+                        event = self._codec.decode(data)
+                        if '@extra' in event:
+                            self._resolve_request(event)
+                        if handler is not None:
+                            handler(event)
+                        for callback in callbacks:
+                            self._run_callback(callback, event)
+                    except Exception:
+                        logging.exception(f"TDLib JSON: {event_type} handling failed.")
+
+                with self._event_stats_lock:
+                    stats = self._event_stats.setdefault(event_type, [0, 0.0, 0])
+                    stats[0] += 1
+                    stats[1] += time.perf_counter() - handle_start
+                    stats[2] += skipped
+            else:
+                timeout = min(timeout * 2, self._receive_timeout_max)
 
     def __del__(self):
         logging.debug(f"Deleting TelegramWrapper object.")
@@ -220,7 +361,16 @@ class TelegramWrapper:
     def __init__(self,
                  tdlib_log_verbosity: int = 0,
                  tdlib_log_file: str = None,
-                 tdlib_log_max_size: int = 10):
+                 tdlib_log_max_size: int = 10,
+                 receive_timeout_min: float = 1.0,
+                 receive_timeout_max: float = 5.0,
+                 callback_workers: int = 0,
+                 callback_queue_size: int = 1000,
+                 max_in_flight: int = 100,
+                 json_backend: Optional[str] = None,
+                 send_rate: float = 0.3,
+                 send_burst: int = 5,
+                 send_max_retries: int = 5):
         """Initialize TelegramWrapper object.
 
         Args:
@@ -232,6 +382,22 @@ class TelegramWrapper:
             tdlib_log_verbosity: Log verbosity level for TDLib JSON library. Range: [0-5+].
             tdlib_log_file: TDLib JSON library log file location.
             tdlib_log_max_size: TDLib JSON library log file max size (in MB).
+            receive_timeout_min: TDLib receive timeout in seconds used while updates are coming in.
+            receive_timeout_max: Max TDLib receive timeout in seconds. The timeout doubles after every idle receive
+                up to this value. Stopping the wrapper may take up to this time.
+            callback_workers: Number of threads running subscriber callbacks. If 0 - callbacks are run on the receiver
+                thread.
+            callback_queue_size: Max number of subscriber callbacks waiting to be run. When the queue is full, the
+                receiver thread waits for a free slot.
+            max_in_flight: Max number of requests sent to TDLib and not responded yet. When reached, sending waits
+                for a response.
+            json_backend: JSON library used to exchange objects with TDLib: 'orjson' or 'json'. If None - orjson is
+                used if installed.
+            send_rate: Max number of messages per second sent to a single chat. If 0 - messages are sent immediately
+                and requests rejected by Telegram flood limits are not retried.
+            send_burst: Max number of messages sent to a single chat at once after an idle period.
+            send_max_retries: Max number of retries of a message rejected by Telegram flood limits, either in the
+                response to the request or later with updateMessageSendFailed.
 
         Raises:
             ModuleNotFoundError: Cannot locate the TDLib JSON library.
@@ -248,6 +414,7 @@ class TelegramWrapper:
         logging.info("TDLib JSON lib loaded successfully.")
 
         self._init_native_funcs(self._tdjson)
+        self._codec = TdJsonCodec(json_backend)
 
         # Error callback handling
         fatal_error_callback_type = CFUNCTYPE(None, c_char_p)
@@ -266,8 +433,46 @@ class TelegramWrapper:
 
         logging.debug(f"Telegram wrapper callback lists initialization.")
         self._message_sent_callbacks = set()
+        self._message_failed_callbacks = set()
+        self._request_failed_callbacks = set()
+        self._update_subscribers = {}
+        self._update_subscribers_lock = threading.Lock()
         logging.debug(f"Telegram wrapper callback lists initialization finished.")
 
+        # Internal handlers are always run on the receiver thread
+        self._update_handlers = {
+            'updateNewChat': self._process_new_chat,
+            'updateMessageSendSucceeded': self._process_message_send_result,
+            'updateMessageSendFailed': self._process_message_send_result,
+            'updateAuthorizationState': lambda event: self._process_authorization(event['authorization_state']),
+            'error': self._process_error
+        }
+
+        self._extra_counter = itertools.count(1)
+        self._pending_requests = {}
+        self._pending_requests_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._request_stats = {'sent': 0, 'completed': 0, 'failed': 0, 'total_latency': 0.0}
+        self._request_stats_lock = threading.Lock()
+        # Accessed by the receiver thread only
+        self._sending_messages = OrderedDict()
+
+        self._dispatcher = None
+        if callback_workers > 0:
+            self._dispatcher = CallbackDispatcher(callback_workers, callback_queue_size)
+
+        self._scheduler = None
+        if send_rate > 0:
+            self._scheduler = SendScheduler(lambda query: self._td_client_send(query, track=True),
+                                            self._notify_message_failed,
+                                            send_rate, send_burst, send_max_retries)
+
+        self._receive_timeout_min = receive_timeout_min
+        self._receive_timeout_max = max(receive_timeout_min, receive_timeout_max)
+        self._receive_wait_time = 0.0
+        self._event_stats = {}
+        self._event_stats_lock = threading.Lock()
+
         # Keep this section last. New thread may start using resources which are not initialized yet otherwise.
         logging.info(f"TDLib JSON message receiver thread initialization.")
         self._chat_id_map = {}
@@ -283,6 +488,63 @@ class TelegramWrapper:
         """Returns the authentication state ot the wrapper"""
         return self._auth_state
 
+    def get_dispatch_stats(self) -> Optional[Dict[str, float]]:
+        """Get subscriber callbacks dispatching statistics.
+
+        Returns:
+            A dictionary returned by CallbackDispatcher.stats or None if callbacks are run on the receiver thread.
+        """
+        return self._dispatcher.stats() if self._dispatcher is not None else None
+
+    def get_event_stats(self) -> Dict[str, Tuple[int, float, int]]:
+        """Get statistics of TDLib updates processed by the receiver thread.
+
+        Returns:
+            A dictionary mapping an update '@type' to a tuple of the number of received updates, the total time in
+            seconds spent parsing and handling them and the number of updates skipped without parsing because nothing
+            handles them. 'receive_wait' key holds (0, total time spent waiting for updates, 0).
+        """
+        with self._event_stats_lock:
+            res = {event_type: tuple(stats) for event_type, stats in self._event_stats.items()}
+        res['receive_wait'] = (0, self._receive_wait_time, 0)
+        return res
+
+    def get_send_queue_depth(self, chat_id: Optional[int] = None) -> int:
+        """Get the number of messages waiting to be sent because of the rate limits.
+
+        Args:
+            chat_id: ID of the chat. If None - the total over all the chats is returned.
+        Returns:
+            int: Number of messages waiting to be sent.
+        """
+        return self._scheduler.queue_depth(chat_id) if self._scheduler is not None else 0
+
+    def get_request_stats(self) -> Dict[str, float]:
+        """Get statistics of requests tracked until TDLib responded.
+
+        Returns:
+            A dictionary containing next keys:
+                'sent'          - total number of tracked requests.
+                'completed'     - total number of responded requests.
+                'failed'        - number of requests TDLib responded to with an error.
+                'in_flight'     - number of requests waiting for a response.
+                'total_latency' - total time in seconds between sending requests and receiving responses.
+        """
+        with self._request_stats_lock:
+            res = dict(self._request_stats)
+        res['in_flight'] = res['sent'] - res['completed']
+        return res
+
+    def request(self, query: dict) -> Future:
+        """Send a request to TDLib and get a future of its response.
+
+        Args:
+            query: TDLib request object.
+        Returns:
+            Future: Resolved with the response object. Fails with TelegramRequestError if TDLib responds with an error.
+        """
+        return self._td_client_send(query, track=True)
+
     def send_album_message(self, media_list: List[Tuple[str, TelegramAlbumMediaType, str]], **kwargs) -> bool:
         """Send an media album message to a chat specified by either a chat id or chat title.
 
@@ -291,6 +553,8 @@ class TelegramWrapper:
             **chat_id (int): ID of the target chat.
             **chat_title (str): Title of the target chat.
                 Use this option only after executing update_chat_ids at least once.
+            **timeout (float): Time in seconds to wait until TDLib accepts the message. If not specified - the
+                method does not wait.
         Returns:
             bool: True if the message is sent. False otherwise. Delivery is not guaranteed.
         """
@@ -305,8 +569,9 @@ class TelegramWrapper:
         if chat_id is not None:
             logging.debug(f"Sending the album message of {len(media_list)} entities to chat id {chat_id}.")
             contents = [TelegramWrapper._get_media_fie_content(x[0], TelegramMediaType(x[1]), x[2]) for x in media_list]
-            self._td_client_send({'@type': 'sendMessageAlbum', 'chat_id': chat_id, 'input_message_contents': contents})
-            return True
+            return self._send_tracked({'@type': 'sendMessageAlbum',
+                                       'chat_id': chat_id,
+                                       'input_message_contents': contents}, kwargs)
         else:
             return False
 
@@ -323,6 +588,8 @@ class TelegramWrapper:
             **chat_id (int): ID of the target chat.
             **chat_title (str): Title of the target chat.
                 Use this option only after executing update_chat_ids at least once.
+            **timeout (float): Time in seconds to wait until TDLib accepts the message. If not specified - the
+                method does not wait.
         Returns:
             bool: True if the message is sent. False otherwise. Delivery is not guaranteed.
         """
@@ -338,8 +605,8 @@ class TelegramWrapper:
             logging.debug(f"Sending the next media message: {media_path} to chat id {chat_id}.")
             caption_text = kwargs['caption'] if 'caption' in kwargs else ''
             content = TelegramWrapper._get_media_fie_content(media_path, media_type, caption_text)
-            self._td_client_send({'@type': 'sendMessage', 'chat_id': chat_id, 'input_message_content': content})
-            return True
+            return self._send_tracked({'@type': 'sendMessage', 'chat_id': chat_id, 'input_message_content': content},
+                                      kwargs)
         else:
             return False
 
@@ -351,6 +618,8 @@ class TelegramWrapper:
             **chat_id (int): ID of the target chat.
             **chat_title (str): Title of the target chat.
                 Use this option only after executing update_chat_ids at least once.
+            **timeout (float): Time in seconds to wait until TDLib accepts the message. If not specified - the
+                method does not wait.
         Returns:
             bool: True if the message is sent. False otherwise. Delivery is not guaranteed.
         """
@@ -365,8 +634,8 @@ class TelegramWrapper:
         if chat_id is not None:
             logging.debug(f"Sending the next text message: {text} to chat id {chat_id}.")
             content = {'@type': 'inputMessageText', 'text': {'text': text}}
-            self._td_client_send({'@type': 'sendMessage', 'chat_id': chat_id, 'input_message_content': content})
-            return True
+            return self._send_tracked({'@type': 'sendMessage', 'chat_id': chat_id, 'input_message_content': content},
+                                      kwargs)
         else:
             return False
 
@@ -457,6 +726,21 @@ class TelegramWrapper:
             self._receive_handler_thread.join()
             self._receive_handler_stop = None
             self._receive_handler_thread = None
+        if self._scheduler is not None:
+            self._scheduler.stop()
+            self._scheduler = None
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+            self._dispatcher = None
+
+    def subscribe_message_failed(self, callback: Callable[[dict], None]):
+        """Subscribe to receive messages which failed to be sent and are not retried any more.
+
+        Args:
+            callback: Callback function. The message will be passed as an argument when calling the callback.
+        """
+        if callback not in self._message_failed_callbacks:
+            self._message_failed_callbacks.add(callback)
 
     def subscribe_message_sent(self, callback: Callable[[dict], None]):
         """Subscribe to receive confirmations that the message has been sent.
@@ -467,6 +751,39 @@ class TelegramWrapper:
         if callback not in self._message_sent_callbacks:
             self._message_sent_callbacks.add(callback)
 
+    def subscribe_request_failed(self, callback: Callable[[str], None]):
+        """Subscribe to receive media files of send requests rejected by TDLib, which are not sent at all. Only the
+        requests made without a timeout are reported, the others return False instead.
+
+        Args:
+            callback: Callback function. The path to the media file will be passed as an argument when calling the
+                callback.
+        """
+        if callback not in self._request_failed_callbacks:
+            self._request_failed_callbacks.add(callback)
+
+    def subscribe_update(self, update_type: str, callback: Callable[[dict], None]):
+        """Subscribe to receive TDLib updates of a specific type.
+
+        Args:
+            update_type: TDLib '@type' of the update, e.g. 'updateNewMessage'.
+            callback: Callback function. The update will be passed as an argument when calling the callback.
+        """
+        with self._update_subscribers_lock:
+            callbacks = self._update_subscribers.get(update_type, ())
+            if callback not in callbacks:
+                # Replaced, not modified, so the receiver thread can iterate callbacks without locking
+                self._update_subscribers[update_type] = callbacks + (callback,)
+
+    def unsubscribe_message_failed(self, callback: Callable[[dict], None]):
+        """Unsubscribe from receiving messages which failed to be sent.
+
+        Args:
+            callback: Callback function previously passed to subscribe_message_failed.
+        """
+        if callback in self._message_failed_callbacks:
+            self._message_failed_callbacks.remove(callback)
+
     def unsubscribe_message_sent(self, callback: Callable[[dict], None]):
         """Unsubscribe from receiving confirmations that the message has been sent.
 
@@ -476,11 +793,36 @@ class TelegramWrapper:
         if callback in self._message_sent_callbacks:
             self._message_sent_callbacks.remove(callback)
 
-    def update_chat_ids(self, limit: int = 1000):
+    def unsubscribe_request_failed(self, callback: Callable[[str], None]):
+        """Unsubscribe from receiving media files of rejected send requests.
+
+        Args:
+            callback: Callback function previously passed to subscribe_request_failed.
+        """
+        if callback in self._request_failed_callbacks:
+            self._request_failed_callbacks.remove(callback)
+
+    def unsubscribe_update(self, update_type: str, callback: Callable[[dict], None]):
+        """Unsubscribe from receiving TDLib updates of a specific type.
+
+        Args:
+            update_type: TDLib '@type' of the update.
+            callback: Callback function previously passed to subscribe_update.
+        """
+        with self._update_subscribers_lock:
+            callbacks = self._update_subscribers.get(update_type, ())
+            if callback in callbacks:
+                self._update_subscribers[update_type] = tuple(x for x in callbacks if x != callback)
+
+    def update_chat_ids(self, limit: int = 1000, timeout: Optional[float] = None) -> bool:
         """Update the list of chat IDs. It is needed for successful send_text_message execution with only chat title
         specified.
 
         Args:
             limit: Max number of chats to be received. Most recent chats will be received.
+            timeout: Time in seconds to wait until the chat IDs are updated. If None - the method does not wait.
+        Returns:
+            bool: True if the chat IDs are updated or the method did not wait. False otherwise.
         """
-        self._td_client_send({'@type': 'getChats', 'limit': limit})
+        # TDLib sends updateNewChat for every chat before the response listing it
+        return self._send_tracked({'@type': 'getChats', 'limit': limit}, {'timeout': timeout})
@@ -7,7 +7,8 @@ from telegram.telegram_wrapper import TelegramMediaType
 class TelegramHelper:
     @staticmethod
     def determine_media_type(file_path: str) -> TelegramMediaType:
-        """Determine the type of media of a file based on its extension.
+        """Determine the type of media of a file based on its extension. MP4 files converted from GIFs are named
+        *.gif.mp4 and are animations.
 
         Args:
             file_path: Path to media file.
@@ -16,7 +17,7 @@ class TelegramHelper:
         """
         ext = os.path.splitext(file_path)[1][1:]
         ret_type = TelegramMediaType.DOCUMENT
-        if ext == 'gif':
+        if ext == 'gif' or file_path.endswith('.gif.mp4'):
             ret_type = TelegramMediaType.ANIMATION
         elif ext == 'jpg' or ext == 'png':
             ret_type = TelegramMediaType.IMAGE
@@ -1,14 +1,83 @@
 """Utility functions."""
 import filetype
+import logging
+from metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS
 import os
-import subprocess
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from typing import BinaryIO, Dict, Optional
+from urllib.parse import urlsplit
 
 
 class DownloadManager:
+    """Downloads media files in-process. Keep-alive connections are pooled per host, so consecutive downloads from
+    i.redd.it, v.redd.it, i.imgur.com and similar hosts reuse already opened connections."""
+
+    chunk_size = 64 * 1024  # bytes
+    pool_size = 8  # connections kept alive per host
+    timeout = 30  # sec
+
+    _sessions: Dict[str, requests.Session] = {}
+    _sessions_lock = threading.Lock()
+
+    @staticmethod
+    def _get_session(download_url: str) -> requests.Session:
+        host = urlsplit(download_url).netloc
+        with DownloadManager._sessions_lock:
+            session = DownloadManager._sessions.get(host)
+            if session is None:
+                logging.debug(f"Creating HTTP connection pool for host {host}.")
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DownloadManager.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                DownloadManager._sessions[host] = session
+            return session
+
+    @staticmethod
+    def close_sessions():
+        """Close all pooled connections."""
+        with DownloadManager._sessions_lock:
+            for session in DownloadManager._sessions.values():
+                session.close()
+            DownloadManager._sessions.clear()
+
+    @staticmethod
+    def copy_stream(response: requests.Response, out_stream: BinaryIO, first_chunk: bytes = b'') -> bool:
+        """Write the content of a streamed response to a binary stream chunk by chunk.
+
+        Args:
+            response: Response returned by open_stream.
+            out_stream: Binary stream to write to. Can be a file or a pipe.
+            first_chunk: Already consumed beginning of the response content.
+
+        Returns:
+            bool: True if the whole content is written. False otherwise.
+        """
+        start = time.perf_counter()
+        host = urlsplit(response.url).netloc
+        size = len(first_chunk)
+        try:
+            out_stream.write(first_chunk)
+            for chunk in response.iter_content(chunk_size=DownloadManager.chunk_size):
+                out_stream.write(chunk)
+                size += len(chunk)
+        except (requests.RequestException, OSError) as e:
+            logging.error(f"Failed to stream {response.url}: {e}")
+            return False
+        finally:
+            response.close()
+            DOWNLOAD_BYTES.inc(size, host=host)
+        # Time to the response headers is measured by requests
+        DOWNLOAD_SECONDS.observe(response.elapsed.total_seconds() + time.perf_counter() - start, host=host)
+        return True
 
     @staticmethod
-    def download_media(download_url: str, file_path: str, default_extension: str) -> str:
-        """Download a file to a specified location.
+    def download_media(download_url: str, file_path: str, default_extension: str) -> Optional[str]:
+        """Download a file to a specified location. The file type is determined from the first received chunk, so the
+        file is written directly under its final name.
 
         Args:
             download_url: URL to download the file from.
@@ -16,12 +85,51 @@ class DownloadManager:
             default_extension: Default extension of the file
 
         Returns:
-            str: Actual location of the saved file.
+            str or None: Actual location of the saved file. None if the download failed.
         """
-        subprocess.run(['wget', download_url, '-O', file_path, '-q'])
-        kind = filetype.guess(file_path)
+        response = DownloadManager.open_stream(download_url)
+        if response is None:
+            return None
+
+        try:
+            first_chunk = next(response.iter_content(chunk_size=DownloadManager.chunk_size), b'')
+        except requests.RequestException as e:
+            logging.error(f"Failed to download {download_url}: {e}")
+            response.close()
+            return None
+
+        kind = filetype.guess(first_chunk) if len(first_chunk) > 0 else None
         new_name = f"{file_path}.{default_extension}"
         if kind is not None:
             new_name = f"{file_path}.{kind.extension}"
-        os.rename(file_path, new_name)
+
+        with open(new_name, 'wb') as out_file:
+            success = DownloadManager.copy_stream(response, out_file, first_chunk)
+
+        if not success:
+            os.remove(new_name)
+            return None
         return new_name
+
+    @staticmethod
+    def open_stream(download_url: str) -> Optional[requests.Response]:
+        """Start downloading a file without reading its content.
+
+        Args:
+            download_url: URL to download the file from.
+
+        Returns:
+            requests.Response or None: Streamed response with a successful status code. None if the request failed.
+                The response should be consumed with copy_stream or closed by the caller.
+        """
+        response = None
+        try:
+            session = DownloadManager._get_session(download_url)
+            response = session.get(download_url, stream=True, timeout=DownloadManager.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Failed to download {download_url}: {e}")
+            if response is not None:
+                response.close()
+            return None
+        return response
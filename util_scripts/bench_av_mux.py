@@ -0,0 +1,103 @@
+"""Latency benchmark of reddit video and audio muxing modes of SubmissionMediaExtractor.
+
+Fixture files are generated with ffmpeg and served from a local HTTP server with an artificial first byte latency to
+emulate a remote host. Compared modes: 'sequential' - the original video, then audio, then mux sequence, 'file' -
+concurrent downloads to disk followed by mux, 'pipe' - concurrent downloads streamed to ffmpeg. Usage:
+
+    python util_scripts/bench_av_mux.py [--runs 10] [--latency 0.2] [--duration 30]
+"""
+import argparse
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from reddit.subreddit_browser import SubmissionMediaExtractor  # noqa: E402
+from utils import DownloadManager  # noqa: E402
+
+
+class DelayedHandler(SimpleHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generate_fixtures(fixture_dir: str, duration: int):
+    # Fragmented MP4, the same layout reddit uses for DASH tracks
+    subprocess.run(['ffmpeg', '-loglevel', 'panic', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size=1280x720',
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-movflags', 'frag_keyframe+empty_moov',
+                    f'{fixture_dir}/video.mp4'], check=True)
+    subprocess.run(['ffmpeg', '-loglevel', 'panic', '-y', '-f', 'lavfi', '-i', f'sine=duration={duration}',
+                    '-c:a', 'aac', '-movflags', 'frag_keyframe+empty_moov',
+                    f'{fixture_dir}/audio.mp4'], check=True)
+
+
+def mux_sequential(video_url: str, audio_url: str, out_file: str):
+    # The original behaviour: video download, then audio download, then mux
+    base_path = os.path.splitext(out_file)[0]
+    video_file = DownloadManager.download_media(video_url, f'{base_path}_video', 'mp4')
+    audio_file = DownloadManager.download_media(audio_url, f'{base_path}_audio', 'mp4')
+    subprocess.run(['ffmpeg', '-loglevel', 'panic', '-y', '-i', video_file, '-i', audio_file, '-c', 'copy', out_file])
+    os.remove(video_file)
+    os.remove(audio_file)
+    return out_file if os.path.isfile(out_file) else None
+
+
+def run_mode(mode: str, base_url: str, out_dir: str, runs: int):
+    extractor = SubmissionMediaExtractor(out_dir, mode)
+    if mode == 'sequential':
+        mux = mux_sequential
+    else:
+        mux = extractor._mux_av_piped if mode == 'pipe' else extractor._mux_av_files
+    timings = []
+    for i in range(runs):
+        out_file = f'{out_dir}/{mode}_{i}.mp4'
+        start = time.perf_counter()
+        result = mux(f'{base_url}/video.mp4', f'{base_url}/audio.mp4', out_file)
+        timings.append(time.perf_counter() - start)
+        if result is None:
+            raise RuntimeError(f"Mode {mode} failed to produce {out_file}")
+        os.remove(result)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.2, help='Emulated first byte latency, sec.')
+    parser.add_argument('--duration', type=int, default=30, help='Fixture video duration, sec.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as fixture_dir, tempfile.TemporaryDirectory() as out_dir:
+        generate_fixtures(fixture_dir, args.duration)
+
+        DelayedHandler.latency = args.latency
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(DelayedHandler, directory=fixture_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        try:
+            for mode in ('sequential', 'file', 'pipe'):
+                timings = run_mode(mode, base_url, out_dir, args.runs)
+                print(f"{mode:>10}: mean {statistics.mean(timings) * 1000:8.1f} ms, "
+                      f"median {statistics.median(timings) * 1000:8.1f} ms, "
+                      f"min {min(timings) * 1000:8.1f} ms")
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark of perceptual hash lookups against the index size.
+
+HammingIndex used by PerceptualHashIndex is compared to a BK-tree and to a linear scan over the same random 64-bit
+hashes. Half of the queries are near-duplicates of indexed hashes, the other half are random. Usage:
+
+    python util_scripts/bench_phash_index.py [--sizes 1000 10000 100000] [--queries 1000] [--distance 6]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from reddit.phash import HammingIndex, PerceptualHash  # noqa: E402
+
+
+class BKTree:
+    """Reference BK-tree. A node is a [hash, {distance to parent: child node}] list."""
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.root = None
+
+    def add(self, value):
+        node = [value, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = PerceptualHash.distance(value, current[0])
+            if distance == 0:
+                return
+            if distance not in current[1]:
+                current[1][distance] = node
+                return
+            current = current[1][distance]
+
+    def search(self, value):
+        matches = []
+        stack = [self.root]
+        while len(stack) > 0:
+            node_value, children = stack.pop()
+            distance = PerceptualHash.distance(value, node_value)
+            if distance <= self.max_distance:
+                matches.append((distance, node_value))
+            stack.extend(child for child_distance, child in children.items()
+                         if abs(child_distance - distance) <= self.max_distance)
+        return sorted(matches)
+
+
+class LinearScan:
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.hashes = []
+
+    def add(self, value):
+        self.hashes.append(value)
+
+    def search(self, value):
+        matches = [(PerceptualHash.distance(value, x), x) for x in self.hashes]
+        return sorted(x for x in matches if x[0] <= self.max_distance)
+
+
+def flip_bits(value, bits, rng):
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--distance', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{args.queries} queries per size, max distance {args.distance}, latency per lookup")
+    for size in args.sizes:
+        hashes = [rng.getrandbits(64) for _ in range(size)]
+        queries = [flip_bits(rng.choice(hashes), rng.randint(0, args.distance), rng) if i % 2 == 0
+                   else rng.getrandbits(64) for i in range(args.queries)]
+        # The slow indexes are measured on a sample of the queries
+        sample = max(10, args.queries * 1000 // size)
+
+        expected = None
+        results = []
+        for name, index_type, num_queries in (('HammingIndex', HammingIndex, args.queries),
+                                              ('BK-tree', BKTree, sample),
+                                              ('linear scan', LinearScan, sample)):
+            index = index_type(args.distance)
+            build_start = time.perf_counter()
+            for value in hashes:
+                index.add(value)
+            build_time = time.perf_counter() - build_start
+
+            search_start = time.perf_counter()
+            matches = [index.search(x) for x in queries[:num_queries]]
+            latency = (time.perf_counter() - search_start) / num_queries * 10 ** 6
+
+            expected = matches if expected is None else expected
+            assert matches == expected[:num_queries], f"{name} results differ"
+            results.append(f"{name} {latency:9.1f} us (build {build_time:6.3f} s)")
+
+        print(f"{size:>9} hashes: " + ", ".join(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Micro-benchmark of TDLib JSON decoding paths of TelegramWrapper.
+
+Sample TDLib payloads are read from fixtures/tdlib_payloads.jsonl, one serialized object per line. Compared paths:
+'legacy' - json.loads of a decoded str, as the receiver thread did originally, 'json' and 'orjson' - TdJsonCodec
+backends decoding every object, 'orjson+peek' - '@type' peeking with full parsing only for the handled types.
+Usage:
+
+    python util_scripts/bench_td_codec.py [--rounds 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telegram.codec import TdJsonCodec, orjson  # noqa: E402
+
+# Update types the wrapper handles by default
+HANDLED_TYPES = {'updateNewChat', 'updateMessageSendSucceeded', 'updateAuthorizationState', 'error'}
+
+
+def load_payloads():
+    fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'tdlib_payloads.jsonl')
+    with open(fixture_path, 'rb') as fixture:
+        return [line.rstrip(b'\n') for line in fixture if line.strip()]
+
+
+def legacy_decode(payloads):
+    for data in payloads:
+        json.loads(data.decode('utf-8'))
+
+
+def codec_decode(codec, payloads):
+    for data in payloads:
+        codec.decode(data)
+
+
+def codec_peek_decode(codec, payloads):
+    for data in payloads:
+        if codec.peek_type(data) in HANDLED_TYPES or codec.has_extra(data):
+            codec.decode(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    payloads = load_payloads()
+    total_bytes = sum(len(x) for x in payloads)
+    print(f"{len(payloads)} payloads, {total_bytes} bytes per round, {args.rounds} rounds")
+
+    cases = [('legacy', lambda: legacy_decode(payloads))]
+    json_codec = TdJsonCodec('json')
+    cases.append(('json', lambda: codec_decode(json_codec, payloads)))
+    cases.append(('json+peek', lambda: codec_peek_decode(json_codec, payloads)))
+    if orjson is not None:
+        orjson_codec = TdJsonCodec('orjson')
+        cases.append(('orjson', lambda: codec_decode(orjson_codec, payloads)))
+        cases.append(('orjson+peek', lambda: codec_peek_decode(orjson_codec, payloads)))
+    else:
+        print("orjson is not installed, skipping orjson cases")
+
+    for name, case in cases:
+        elapsed = timeit.timeit(case, number=args.rounds)
+        per_object = elapsed / (args.rounds * len(payloads)) * 10 ** 6
+        print(f"{name:>12}: {elapsed:8.3f} s total, {per_object:6.2f} us per object, "
+              f"{total_bytes * args.rounds / elapsed / 10 ** 6:8.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()